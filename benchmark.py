@@ -0,0 +1,449 @@
+import argparse
+import contextlib
+import getopt
+import io
+import ipaddress
+import random
+import shlex
+import time
+import timeit
+import tracemalloc
+from collections import defaultdict
+
+from ine_simulator import INESimulator
+from itrinegy import BaseIT, IT
+
+
+def legacyParseViSettings(result):
+    # The shlex + getopt parser BaseIT.parseViSettings replaced, kept here to compare against
+    result = shlex.split(result)
+    try:
+        optlist = getopt.getopt(result, '', ['id=', 'name=', 'setUserGivenId=', 'vitype=', 'groupname=', 'xpos=',
+                                             'ypos=', 'width=', 'height=', 'objdir=', 'image=', 'notes=', 'meta=', 'procModule='])[0]
+        full_list = defaultdict(list)
+        for k, v in optlist:
+            if k == "--procModule":
+                full_list[k.replace("--", "")].append(v)
+            else:
+                full_list.update({k.replace("--", ""): v})
+    except getopt.GetoptError:
+        full_list = None
+    return full_list
+
+
+def sampleViSettings(routes=10):
+    # A --getVISettings reply shaped like the ones amendVi produces for a router with this many routes
+    route_fields = ''.join(
+        'Routes[' + str(n) + '].Route_Disabled;0;Routes[' + str(n) + '].Port_In;Virtual;Routes[' + str(n) +
+        '].Port_Out;Device' + str(n) + '-GW0;Routes[' + str(n) + '].Network_Mask;255.255.255.252;Routes[' + str(n) +
+        '].Network_Address;10.' + str(n // 256) + '.' + str(n % 256) + '.0;' for n in range(routes))
+    return ('--id "42" --name "Internet" --setUserGivenId "0" --vitype "picture" --groupname "Internet" '
+            '--xpos "650" --ypos "670" --width "80" --height "80" --objdir "0" --image "Standard/Router.png" --notes "" '
+            '--procModule "Default:Debug;10;Dump_Packet;0;Bytes_to_Dump;80;" '
+            '--procModule "Default:Generic_Filter;20;" '
+            '--procModule "Default:Random_Drop;30;Loss_Percent;1.5;" '
+            '--procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;0.0;" '
+            '--procModule "Default:Random_Delay;50;Min_Delay;25.0;Max_Delay;25.1;" '
+            '--procModule "Default:Fragment_MTU;55;MTU_Limit;0;Dont_Fragment_Flag_Option;Fragment Anyway;" '
+            '--procModule "Default:IPv4_Routing;60;' + route_fields + 'Port_In;;Port_Out;;" '
+            '--procModule "Default:Packet_Move_and_Duplicate;62;Selection_Percent;0.0;Duplicate_Packet;0;Minimum_Move;0;Maximum_Move;0;" '
+            '--procModule "Default:Random_Packet_Move_Offset;65;Move_Percent;0.0;Minimum_Move;1;Maximum_Move;1;" '
+            '--procModule "Default:Linkspeed_and_FIFO_Queue_Bytes;70;Link_Type;Manual;Link_Speed;0;Queue_Length;64000;Overhead;18;Congestion_PCT;0.0;TTL_Cost;0;"')
+
+
+def timePerCall(func, *args):
+    # Seconds per call, timed over enough calls to take at least 0.2s
+    timer = timeit.Timer(lambda: func(*args))
+    number, elapsed = timer.autorange()
+    return min([elapsed] + timer.repeat(repeat=2, number=number)) / number
+
+
+def benchmarkViSettingsParser(route_counts=(0, 10, 100, 1000)):
+    base = BaseIT("", 0, "", "")
+    print("--getVISettings parser, microseconds per reply")
+    print("%8s %10s %12s %12s %8s" % ("routes", "bytes", "shlex/getopt", "single pass", "speedup"))
+    for routes in route_counts:
+        reply = sampleViSettings(routes)
+        if legacyParseViSettings(reply) != base.parseViSettings(reply):
+            raise AssertionError("Parsers disagree on a reply with " + str(routes) + " routes")
+        legacy = timePerCall(legacyParseViSettings, reply)
+        current = timePerCall(base.parseViSettings, reply)
+        print("%8d %10d %12.1f %12.1f %7.1fx" % (routes, len(reply), legacy * 1e6, current * 1e6, legacy / current))
+
+
+def legacyParsePorts(result):
+    # The split based parser BaseIT.parsePorts replaced, kept here to compare against
+    header, data = result.split(' ', 1)
+    # kill off double and single quote chars from front and back
+    data = data.strip('"\'')
+    parts = data.split(';')  # create an array of the ; separated items
+    portCount = int(parts[0])
+    # Drop the first entry as it's just a count
+    parts.pop(0)
+    ports = []
+    for PortNum in range(portCount):
+        ports.append(
+            {"id": int(parts[(PortNum*6+0)]),
+             "name": parts[(PortNum*6+1)],
+             "parent": int(parts[(PortNum*6+2)]) if parts[(PortNum*6+2)] != "-1" else None,
+             "type": parts[(PortNum*6+4)],
+             "subtype": parts[(PortNum*6+5)] if parts[(PortNum*6+5)] != "" else None
+             })
+    return ports
+
+
+def samplePorts(count):
+    # A --getAllPorts reply with the two WAN interfaces and count ports split between VLANs and IPv4
+    parts = ["0", "0", "-1", "0", "Hardware", "", "1", "1", "-1", "0", "Hardware", ""]
+    for number in range(2, count):
+        if number % 2 == 0:
+            parts += [str(number), str(number % 4 // 2) + "." + str(number), str(number % 4 // 2), "0", "VLAN", ""]
+        else:
+            parts += [str(number), "10." + str(number // 65536) + "." + str(number // 256 % 256) + "." + str(number % 256),
+                      str(number - 1), "0", "IPv4", ""]
+    return '--ports "' + str(count) + ';' + ';'.join(parts) + '"'
+
+
+def benchmarkPortsParser(port_counts=(1000, 10000, 100000)):
+    # Finding one port by name in a --getAllPorts reply, by parsing the lot or streaming it
+    base = BaseIT("", 0, "", "")
+
+    def legacyFind(reply, name):
+        return next((port for port in legacyParsePorts(reply) if port["name"] == name), None)
+
+    def streamFind(reply, name):
+        return next((port for port in base.streamPorts(reply) if port["name"] == name), None)
+
+    print("--getAllPorts parser, finding the last port by name")
+    print("%8s %10s %10s %10s %12s %12s" % ("ports", "bytes", "split ms", "stream ms", "split KB", "stream KB"))
+    for count in port_counts:
+        reply = samplePorts(count)
+        name = legacyParsePorts(reply)[-1]["name"]
+        if legacyParsePorts(reply) != base.parsePorts(reply) or legacyFind(reply, name) != streamFind(reply, name):
+            raise AssertionError("Parsers disagree on a reply with " + str(count) + " ports")
+        peaks = []
+        for find in (legacyFind, streamFind):
+            tracemalloc.start()
+            find(reply, name)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        print("%8d %10d %10.2f %10.2f %12.0f %12.0f" % (
+            count, len(reply), timePerCall(legacyFind, reply, name) * 1000, timePerCall(streamFind, reply, name) * 1000,
+            peaks[0] / 1024, peaks[1] / 1024))
+
+
+def legacyAmendCommand(vi):
+    # The string concatenating builder BaseIT.amendCommand replaced, kept here to compare against
+    command = '--id ' + vi["id"] + ' '
+    groupname = vi["name"]
+    vitype = "picture"
+    # Mandatory procs need applying
+    command += '--procModule "Default:Debug;10;Dump_Packet;0;Bytes_to_Dump;80;" ' + \
+               '--procModule "Default:Generic_Filter;20;" ' + \
+               '--procModule "Default:Random_Drop_with_Burst;30;Loss_Percent;0.0;Minimum_Packets_to_Drop;1;Maximum_Packets_to_Drop;1;" ' + \
+               '--procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;0.0;" ' + \
+               '--procModule "Default:Step_Delay_Packet_Nanoseconds;50;Min_Delay;0;Max_Delay;0;Step_Delay;0;" ' + \
+               '--procModule "Default:Fragment_MTU;55;MTU_Limit;0;Dont_Fragment_Flag_Option;Fragment Anyway;" '
+    # Apply routing depending on which type of object it is
+    if vi.get("address"):
+        command += '--procModule "Default:Symmetric_Routing;60;'
+        if vi.get("parent"):
+            command += 'Routes[0].Port_Out;' + vi["parent"] + \
+                ';Routes[0].Port_In;' + str(vi["address"]) + ';'
+        command += 'Port_In;' + \
+            str(vi["address"]) + ';Port_Out;' + str(vi["address"]) + ';" '
+        image = 'LAN/Port.png'
+    else:
+        image = 'Standard/Router.png'
+    if vi["objdir"] > 0:
+        command += '--procModule "Default:Generic_Routing;60;' + \
+                   'Port_In;Virtual;' + \
+                   'Port_Out;' + vi["parent"] + ';" '
+        image = 'Standard/FullDuplex.png'
+        groupname = vi["groupname"]
+        vitype = "lineobject"
+    if vi.get("routes"):
+        command += '--procModule "Default:IPv4_Routing;60;'
+        for routeNumber, route in enumerate(vi["routes"]):
+            net = ipaddress.ip_network(
+                route["ip"] + '/' + route["mask"], strict=False)
+            command += 'Routes[' + str(routeNumber) + '].Route_Disabled;0;' + \
+                'Routes[' + str(routeNumber) + '].Port_In;Virtual;' + \
+                'Routes[' + str(routeNumber) + '].Port_Out;' + route["portOut"] + ';' + \
+                'Routes[' + str(routeNumber) + '].Network_Mask;' + str(net.netmask) + ';' + \
+                'Routes[' + str(routeNumber) + '].Network_Address;' + \
+                str(net.network_address) + ';'
+        command += 'Port_In;;Port_Out;;" '
+
+    # Now for more mandatory procs
+    command += '--procModule "Default:Packet_Move_and_Duplicate;62;Selection_Percent;0.0;Duplicate_Packet;0;Minimum_Move;0;Maximum_Move;0;" ' + \
+               '--procModule "Default:Random_Packet_Move_Offset;65;Move_Percent;0.0;Minimum_Move;1;Maximum_Move;1;" ' + \
+               '--procModule "Default:Linkspeed_and_FIFO_Queue_Bytes;70;Link_Type;Manual;Link_Speed;0;Queue_Length;64000;Overhead;18;Congestion_PCT;0.0;TTL_Cost;0;" '
+    if vitype == "lineobject":
+        command += '--procModule "Default:;80;" '
+
+    command += '--vitype "' + vitype + '" '
+    command += '--groupname "' + groupname + '" '
+    command += '--xpos ' + str(vi["xpos"]) + ' --ypos ' + str(vi["ypos"]) + ' --width ' + str(vi["width"]) + ' --height ' + \
+        str(vi["height"]) + ' --objdir ' + str(vi["objdir"]) + ' '
+    command += '--image "' + image + '" '
+    command += '--notes "" '
+    return command
+
+
+def legacyPortCommands(interface, vlan, address, mask, gateway):
+    vlan_command = '--portModule "Default:Hardware_VLAN_Routing;' + str(interface) + ';VLAN_Interfaces[0].Interface_Name;' + str(interface) + '.' + str(
+        vlan) + ';VLAN_Interfaces[0].Use_As_Default_Interface;False;VLAN_Interfaces[0].VLAN_Id;' + str(vlan) + ';VLAN_Interfaces[0].Detag_Packets_on_Output;False"'
+    ipv4_command = '--portModule "Default:Hardware_IPv4_Routing;' + str(interface) + '.' + str(vlan) + ';IPv4_Interfaces[0].Netmask;' + str(mask) + ';IPv4_Interfaces[0].Interface_Name;' + str(address) + ';IPv4_Interfaces[0].Gateway;' + (
+        str(gateway) if gateway is not None else '') + ';IPv4_Interfaces[0].Accept_Multicast_Traffic;No;IPv4_Interfaces[0].Address;' + str(address) + ';IPv4_Interfaces[0].Use_DHCP_Relay;No"'
+    return vlan_command, ipv4_command
+
+
+def sampleVis(devices):
+    # The VIs createEmulation amends for a product with this many devices, laid out the same way
+    base = BaseIT("", 0, "", "")
+    FW_Vi, Outer_Vi, Internet_Vi, MPLS_Vi, device_vis = base.planEmulation(
+        BenchmarkProduct("Benchmark"), [BenchmarkDevice(number) for number in range(devices)])
+    links = base.planLinks(MPLS_Vi, Outer_Vi) + base.planLinks(Internet_Vi, Outer_Vi) + base.planLinks(Outer_Vi, FW_Vi)
+    vis = [base.planObjectVi(vi) for vi in device_vis + [MPLS_Vi, Internet_Vi, Outer_Vi, FW_Vi]] + links
+    for number, vi in enumerate(vis):
+        vi["id"] = str(1000 + number)
+    return vis
+
+
+def benchmarkCommandBuilder(device_counts=(10, 100, 1000)):
+    # Builds, and encodes for the socket, the amend command of every VI in a product
+    base = BaseIT("", 0, "", "")
+    session_id = "0123456789abcdef0123456789abcdef"
+
+    def legacy(vi):
+        return (session_id + ' ' + legacyAmendCommand(vi) + '\n').encode('utf-8')
+
+    def current(vi):
+        # The pieces sendCommand writes out, without joining them
+        return base.encodeCommand(base.amendCommand(vi), session_id)
+
+    def buildAll(build, vis):
+        for vi in vis:
+            build(vi)
+
+    print("amendVi command builder, microseconds per VI and peak bytes allocated building the largest one")
+    print("%8s %6s %10s %10s %8s %12s %12s" % ("devices", "VIs", "strings", "bytes", "speedup", "strings B", "bytes B"))
+    for devices in device_counts:
+        vis = sampleVis(devices)
+        peaks = []
+        for build in (legacy, current):
+            # Built once first so route_network's cache isn't counted
+            buildAll(build, vis)
+            peak = 0
+            tracemalloc.start()
+            try:
+                for vi in vis:
+                    tracemalloc.reset_peak()
+                    build(vi)
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            peaks.append(peak)
+        for vi in vis:
+            if legacy(vi) != b''.join(current(vi)):
+                raise AssertionError("Command builders disagree on VI " + vi["name"])
+        old = timePerCall(buildAll, legacy, vis) / len(vis)
+        new = timePerCall(buildAll, current, vis) / len(vis)
+        print("%8d %6d %10.1f %10.1f %7.1fx %12d %12d" % (
+            devices, len(vis), old * 1e6, new * 1e6, old / new, peaks[0], peaks[1]))
+    for args in ((0, 1000, "10.1.0.2", "255.255.255.252", None), (1, 2000, "10.2.0.2", 30, "10.2.0.1")):
+        if tuple(command.encode() for command in legacyPortCommands(*args)) != base.portCommands(*args):
+            raise AssertionError("Port command builders disagree on " + repr(args))
+
+
+def routeLookup(routes, address):
+    # The portOuts longest prefix matching picks for address, more than one only on an exact tie
+    best = None
+    ports = set()
+    for route in routes:
+        network = ipaddress.ip_network(route["ip"] + '/' + route["mask"])
+        if address in network:
+            if best is None or network.prefixlen > best:
+                best = network.prefixlen
+                ports = set()
+            if network.prefixlen == best:
+                ports.add(route["portOut"])
+    return ports
+
+
+def sampleRoutes(rng, count):
+    # Random routes inside 10.0.0.0/22 between three ports, so they nest, overlap and sit side by side
+    routes = []
+    for _ in range(count):
+        prefix = rng.randint(22, 30)
+        network = ipaddress.ip_network("10.0." + str(rng.randint(0, 3)) + "." + str(rng.randint(0, 255)) +
+                                       "/" + str(prefix), strict=False)
+        routes.append({"ip": str(network.network_address), "mask": str(network.netmask),
+                       "portOut": rng.choice(("wan0", "wan1", "wan2"))})
+    return routes
+
+
+def benchmarkRouteSummarization(trials=500, seed=1):
+    # Checks summarizeRoutes against longest prefix matching, which the INE is assumed to use, on
+    # random route sets: every address at the edge of an original or merged network, and a
+    # sample of others, must leave by the same port before and after
+    base = BaseIT("", 0, "", "")
+    rng = random.Random(seed)
+    before = after = 0
+    elapsed = 0.0
+    for trial in range(trials):
+        routes = sampleRoutes(rng, rng.randint(1, 40))
+        started = time.perf_counter()
+        summarized, removed = base.summarizeRoutes(routes)
+        elapsed += time.perf_counter() - started
+        if len(routes) - len(summarized) != removed:
+            raise AssertionError("summarizeRoutes miscounted the routes it removed in trial " + str(trial))
+        addresses = set()
+        for route in routes + summarized:
+            network = ipaddress.ip_network(route["ip"] + '/' + route["mask"])
+            addresses.update((network.network_address - 1, network.network_address,
+                              network.broadcast_address, network.broadcast_address + 1))
+        addresses.update(ipaddress.ip_address("10.0.0.0") + rng.randint(0, 1023) for _ in range(32))
+        for address in addresses:
+            if routeLookup(routes, address) != routeLookup(summarized, address):
+                raise AssertionError("summarizeRoutes sends " + str(address) + " elsewhere in trial " + str(trial) +
+                                     ": " + repr(routes))
+        before += len(routes)
+        after += len(summarized)
+    print("summarizeRoutes on %d random route sets, all equivalent under longest prefix matching" % trials)
+    print("%10s %10s %10s %14s" % ("routes", "after", "removed", "us per set"))
+    print("%10d %10d %9.1f%% %14.1f" % (before, after, 100.0 * (before - after) / before, elapsed / trials * 1e6))
+
+
+class BenchmarkVlan:
+    def __init__(self, vlan):
+        self.vlan = vlan
+
+
+class BenchmarkAddress:
+    def __init__(self, address, mask):
+        self.address = address
+        self.mask = mask
+
+
+class BenchmarkWan:
+    def __init__(self, address, vlan):
+        self.address = BenchmarkAddress(address, 30)
+        self.vlan = BenchmarkVlan(vlan)
+
+
+class BenchmarkDevice:
+    # Stands in for the device objects createEmulation is normally given
+    def __init__(self, number):
+        self.name = "Device" + str(number)
+        self.wan1 = BenchmarkWan("10.1." + str(number // 64) + "." + str(number % 64 * 4 + 2), 1000 + number)
+        self.wan2 = BenchmarkWan("10.2." + str(number // 64) + "." + str(number % 64 * 4 + 2), 2000 + number)
+
+
+class BenchmarkProduct:
+    def __init__(self, name):
+        self.name = name
+        self.gateway_ip = "192.168.0.1"
+        self.vlan = BenchmarkVlan(10)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if values else 0.0
+
+
+def measure(client, operation):
+    # Runs operation once timing every command it sends, then a second time under tracemalloc for
+    # its peak memory, so tracing doesn't skew the timings. operation must be safe to repeat
+    latencies = []
+    send = client.sendCommand
+
+    def timedSend(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.sendCommand = timedSend
+        try:
+            started = time.perf_counter()
+            operation()
+            elapsed = time.perf_counter() - started
+        finally:
+            del client.sendCommand
+        tracemalloc.start()
+        try:
+            operation()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"commands": len(latencies), "elapsed": elapsed, "rate": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99), "peak": peak}
+
+
+def benchmarkClient(latency=0.001, quick=False):
+    # Drives IT against a local INESimulator, which adds latency seconds to every reply
+    scenarios = [
+        ("getAllVis", [(5, 10), (20, 25)] if quick else [(5, 10), (20, 25), (50, 50)]),
+        ("getPorts", [100, 1000] if quick else [100, 1000, 5000]),
+        ("createEmulation", [10] if quick else [10, 50, 200]),
+        ("bulk impairments", [50] if quick else [50, 200, 1000]),
+    ]
+    print("IT against the INE simulator, " + str(latency * 1000) + "ms added per reply")
+    print("%-18s %12s %9s %10s %9s %9s %10s" % ("operation", "size", "commands", "commands/s", "p50 ms", "p99 ms", "peak KB"))
+    for name, sizes in scenarios:
+        for size in sizes:
+            with INESimulator(latency=latency) as simulator:
+                client = IT(simulator.address[0], simulator.address[1], simulator.username, simulator.password,
+                            pool_size=8, parallelism=8)
+                if name == "getAllVis":
+                    simulator.populate(emulations=size[0], vis_per_emulation=size[1])
+                    label = str(size[0]) + "x" + str(size[1]) + " VIs"
+                    operation = client.getAllVis
+                elif name == "getPorts":
+                    simulator.populate(ports=size // 2)
+                    label = str(size) + " ports"
+                    operation = lambda: client.getPorts(refresh=True)
+                elif name == "createEmulation":
+                    label = str(size) + " devices"
+                    devices = [BenchmarkDevice(number) for number in range(size)]
+                    operation = lambda: client.createEmulation(
+                        BenchmarkProduct("Benchmark"), devices, overwrite=True)
+                else:
+                    simulator.populate(emulations=1, vis_per_emulation=size)
+                    label = str(size) + " VIs"
+                    changes = {vi_id: {"latency": 20, "loss": 1, "errors": 0} for vi_id in simulator.vis}
+                    operation = lambda: client.applyImpairmentsBulk(changes)
+                result = measure(client, operation)
+                client.disconnect()
+            print("%-18s %12s %9d %10.0f %9.2f %9.2f %10.0f" % (
+                name, label, result["commands"], result["rate"], result["p50"] * 1000, result["p99"] * 1000, result["peak"] / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the iTrinegy client")
+    parser.add_argument("suites", nargs="*", metavar="{parser,builder,client}",
+                        help="which benchmarks to run, all of them by default")
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="seconds the simulator adds to every reply")
+    parser.add_argument("--quick", action="store_true", help="only run the smaller sizes")
+    args = parser.parse_args()
+    suites = args.suites or ["parser", "builder", "client"]
+    for suite in suites:
+        if suite not in ("parser", "builder", "client"):
+            parser.error("unknown benchmark " + repr(suite))
+    if "parser" in suites:
+        benchmarkViSettingsParser()
+        benchmarkPortsParser()
+    if "builder" in suites:
+        benchmarkCommandBuilder()
+        benchmarkRouteSummarization()
+    if "client" in suites:
+        benchmarkClient(args.latency, args.quick)
+
+
+if __name__ == "__main__":
+    main()
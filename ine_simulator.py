@@ -0,0 +1,254 @@
+import random
+import socketserver
+import threading
+import time
+
+from itrinegy import OPTION_PATTERN, ProcModule
+
+
+class INESimulator:
+    # An in-process stand-in for an iTrinegy INE, speaking the subset of its command protocol that
+    # IT uses, so the client can be benchmarked and load tested without an appliance.
+    # latency is added to every reply, reply_padding bytes are added to the notes of every VI,
+    # error_rate is the chance a port delete or VI amend fails with a transient "in use" error and
+    # session_ttl expires user sessions after that many seconds
+    def __init__(self, host="127.0.0.1", port=0, username="admin", password="password",
+                 latency=0.0, reply_padding=0, error_rate=0.0, session_ttl=None, seed=None):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.reply_padding = reply_padding
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.random = random.Random(seed)
+        self.stats = {"connections": 0, "commands": 0, "errors": 0}
+        self.emulations = {}
+        self.vis = {}
+        self.ports = {}
+        self.port_names = {}
+        self.sessions = {}
+        self._ids = 0
+        self._lock = threading.RLock()
+        # Hardware ports 0 and 1 are the two WAN interfaces
+        for name in ("0", "1"):
+            self._addPort(name, None, "Hardware")
+        self.server = _Server((host, port), _Handler)
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="ine-simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def populate(self, emulations=0, vis_per_emulation=0, ports=0):
+        # Fill the INE with running emulations made of plain router VIs, and IPv4 ports on their own VLANs
+        with self._lock:
+            for number in range(emulations):
+                emulation_id = self._addEmulation("Emulation " + str(number))
+                self.emulations[emulation_id]["running"] = True
+                for vi_number in range(vis_per_emulation):
+                    vi_id = self._addVi(emulation_id, "VI " + str(vi_number))
+                    self.vis[vi_id]["procModule"] = [
+                        "Default:Random_Delay;50;Min_Delay;10.0;Max_Delay;10.1;",
+                        "Default:Random_Drop;30;Loss_Percent;0.5;",
+                        "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;0.0;"]
+            for number in range(ports):
+                vlan = self._addPort(str(number % 2) + "." + str(100 + number), self._portByName(str(number % 2)), "VLAN")
+                self._addPort(str(10 + number // 65536) + "." + str(number // 256 % 256) + "." + str(number % 256) + ".1",
+                              vlan, "IPv4")
+
+    def handle(self, line):
+        # Returns the reply to one command line, without its trailing newline
+        with self._lock:
+            self.stats["commands"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        options = {}
+        procModules = []
+        for key, quoted, single, bare in OPTION_PATTERN.findall(line):
+            value = quoted or single or bare
+            if key == "procModule":
+                procModules.append(value)
+            options[key] = value
+        with self._lock:
+            reply = self._dispatch(options, procModules)
+            if reply.startswith("--error"):
+                self.stats["errors"] += 1
+            return reply
+
+    def _dispatch(self, options, procModules):
+        if "login" in options:
+            if options["login"] != self.username + ";" + self.password:
+                return '--error "Invalid username or password"'
+            session_id = "%032x" % self.random.getrandbits(128)
+            self.sessions[session_id] = time.monotonic()
+            return '--sessionId "' + session_id + '"'
+        created = self.sessions.get(options.get("sessionId"))
+        if created is None or (self.session_ttl is not None and time.monotonic() - created > self.session_ttl):
+            self.sessions.pop(options.get("sessionId"), None)
+            return '--error "Unable to find user session"'
+
+        if "getemulations" in options:
+            parts = [str(len(self.emulations))]
+            for emulation_id, emulation in self.emulations.items():
+                parts += [str(emulation_id), emulation["name"], "1" if emulation["running"] else "0", "", "0",
+                          self.username, str(emulation["started"]), str(emulation["updated"])]
+            return '--emulations "' + ';'.join(parts) + '"'
+        if "getAllPorts" in options:
+            parts = [str(len(self.ports))]
+            for port_id, port in self.ports.items():
+                parts += [str(port_id), port["name"], str(port["parent"] if port["parent"] is not None else -1), "0",
+                          port["type"], port["subtype"] or ""]
+            return '--ports "' + ';'.join(parts) + '"'
+        if "portModule" in options:
+            return self._portModule(options["portModule"])
+        if "delPortModule" in options:
+            return self._deletePort(int(options["delPortModule"]))
+        if "addEmulation" in options:
+            return "--emulationId " + str(self._addEmulation(options["addEmulation"]))
+
+        if "emulationId" in options:
+            emulation = self.emulations.get(int(options["emulationId"]))
+            if emulation is None:
+                return '--error "No such emulation"'
+            if "getVIsForEmulation" in options:
+                return '--VIsForEmulation "' + str(len(emulation["vis"])) + ';' + \
+                    ''.join(str(vi_id) + ';' for vi_id in emulation["vis"]) + '"'
+            if "addVi" in options:
+                return "--id " + str(self._addVi(int(options["emulationId"]), options["addVi"]))
+            if "start" in options or "stop" in options:
+                emulation["running"] = "start" in options
+                emulation["updated"] = time.time()
+                return "--ok"
+            return '--error "Unknown command"'
+
+        vi = self.vis.get(int(options.get("Id") or options.get("id") or -1))
+        if vi is None:
+            return '--error "No such VI"'
+        if "getVISettings" in options:
+            reply = ' '.join('--' + key + ' "' + str(vi[key]) + '"' for key in ("id", "name", "vitype", "groupname", "xpos", "ypos", "width", "height", "objdir", "image"))
+            reply += ' --notes "' + vi["notes"] + "x" * self.reply_padding + '"'
+            return reply + ''.join(' --procModule "' + module + '"' for module in vi["procModule"])
+        if procModules:
+            return self._amendVi(vi, options, procModules)
+        return '--error "Unknown command"'
+
+    def _amendVi(self, vi, options, procModules):
+        for module in procModules:
+            module = ProcModule(module)
+            if module.name == "Symmetric_Routing":
+                port = self._portByName(module.get("Port_In"))
+                error = '--error "[' + vi["name"] + ' - Default:Symmetric_Routing]: Object ' + vi["name"] + ': '
+                if port is None:
+                    return error + 'No such port (' + module.get("Port_In") + ')"'
+                if self._transientError():
+                    return error + 'Cannot Open a connection to Input port (' + module.get("Port_In") + ') - likely it\'s already in use"'
+        # Modules are replaced by name, anything not mentioned keeps its current settings
+        modules = {ProcModule(module).name: module for module in vi["procModule"]}
+        modules.update((ProcModule(module).name, module) for module in procModules)
+        vi["procModule"] = sorted(modules.values(), key=lambda module: ProcModule(module).order or 0)
+        for key in ("vitype", "groupname", "xpos", "ypos", "width", "height", "objdir", "image", "notes"):
+            if key in options:
+                vi[key] = options[key]
+        self.emulations[vi["emulation"]]["updated"] = time.time()
+        return "--ok"
+
+    def _portModule(self, value):
+        module = ProcModule(value)
+        # The port a module is added to is in the slot where a procModule has its order
+        parent = self._portByName(value.split(';')[1])
+        if parent is None:
+            return '--error "No such port"'
+        if module.name == "Hardware_VLAN_Routing":
+            name, port_type = module.get("VLAN_Interfaces[0].Interface_Name"), "VLAN"
+        elif module.name == "Hardware_IPv4_Routing":
+            name, port_type = module.get("IPv4_Interfaces[0].Address"), "IPv4"
+        else:
+            return '--error "Unknown port module"'
+        if self._portByName(name) is not None:
+            return '--error "Port ' + name + ' already exists"'
+        self._addPort(name, parent, port_type)
+        return "--ok"
+
+    def _deletePort(self, port_id):
+        port = self.ports.get(port_id)
+        if port is None:
+            return '--error "No such port"'
+        if any(child["parent"] == port_id for child in self.ports.values()):
+            return '--error "Port id [' + str(port_id) + '] has a child port and so cannot be deleted'
+        if self._portInUse(port["name"]) or self._transientError():
+            return '--error "Port id [' + str(port_id) + '] is in use in an emulation and so cannot be deleted"'
+        del self.ports[port_id]
+        del self.port_names[port["name"]]
+        return "--ok"
+
+    def _portInUse(self, name):
+        for vi in self.vis.values():
+            if self.emulations[vi["emulation"]]["running"]:
+                for module in vi["procModule"]:
+                    module = ProcModule(module)
+                    if module.name == "Symmetric_Routing" and module.get("Port_In") == name:
+                        return True
+        return False
+
+    def _transientError(self):
+        return self.error_rate and self.random.random() < self.error_rate
+
+    def _nextId(self):
+        self._ids += 1
+        return self._ids
+
+    def _addEmulation(self, name):
+        emulation_id = self._nextId()
+        self.emulations[emulation_id] = {"name": name, "running": False, "vis": [],
+                                         "started": time.time(), "updated": time.time()}
+        return emulation_id
+
+    def _addVi(self, emulation_id, name):
+        vi_id = self._nextId()
+        self.vis[vi_id] = {"id": vi_id, "emulation": emulation_id, "name": name, "vitype": "picture",
+                           "groupname": name, "xpos": 0, "ypos": 0, "width": 80, "height": 80, "objdir": 0,
+                           "image": "Standard/Router.png", "notes": "", "procModule": []}
+        self.emulations[emulation_id]["vis"].append(vi_id)
+        self.emulations[emulation_id]["updated"] = time.time()
+        return vi_id
+
+    def _addPort(self, name, parent, port_type):
+        port_id = self._nextId()
+        self.ports[port_id] = {"name": name, "parent": parent, "type": port_type, "subtype": None}
+        self.port_names[name] = port_id
+        return port_id
+
+    def _portByName(self, name):
+        return self.port_names.get(name)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        simulator = self.server.simulator
+        with simulator._lock:
+            simulator.stats["connections"] += 1
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if line:
+                self.wfile.write((simulator.handle(line) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
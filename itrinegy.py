@@ -1,23 +1,730 @@
+import asyncio
 import socket
+import select
 import sys
+import threading
 import time
-import shlex
-import getopt
-from collections import defaultdict, ChainMap
+from collections import defaultdict, deque, ChainMap
 import re
 import ipaddress
+import random
+import heapq
+import json
+import sqlite3
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# A --key followed by a "double quoted", 'single quoted' or bare value, as found in INE replies
+OPTION_PATTERN = re.compile(
+    r'--(\w+)(?:\s+(?:"([^"\\]*(?:\\.[^"\\]*)*)"|\'([^\']*)\'|(?!--)(\S+)))?')
+# Backslash escapes that are allowed inside a double quoted value
+ESCAPE_PATTERN = re.compile(r'\\(["\\])')
+# The bytes that change whether the end of a reply is inside a quoted value
+QUOTE_PATTERN = re.compile(rb'["\\]')
+# Options that pick what a command acts on rather than what it does
+SELECTOR_OPTIONS = {"Id", "id", "emulationId", "sessionId"}
+VERB_PATTERN = re.compile(r'--(\w+)')
+VERB_BYTES_PATTERN = re.compile(rb'--(\w+)')
+# The procModules every VI gets whatever it is, kept encoded as they're the bulk of every amend
+MANDATORY_PROCS_HEAD = (
+    b'--procModule "Default:Debug;10;Dump_Packet;0;Bytes_to_Dump;80;" '
+    b'--procModule "Default:Generic_Filter;20;" '
+    b'--procModule "Default:Random_Drop_with_Burst;30;Loss_Percent;0.0;Minimum_Packets_to_Drop;1;Maximum_Packets_to_Drop;1;" '
+    b'--procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;0.0;" '
+    b'--procModule "Default:Step_Delay_Packet_Nanoseconds;50;Min_Delay;0;Max_Delay;0;Step_Delay;0;" '
+    b'--procModule "Default:Fragment_MTU;55;MTU_Limit;0;Dont_Fragment_Flag_Option;Fragment Anyway;" ')
+MANDATORY_PROCS_TAIL = (
+    b'--procModule "Default:Packet_Move_and_Duplicate;62;Selection_Percent;0.0;Duplicate_Packet;0;Minimum_Move;0;Maximum_Move;0;" '
+    b'--procModule "Default:Random_Packet_Move_Offset;65;Move_Percent;0.0;Minimum_Move;1;Maximum_Move;1;" '
+    b'--procModule "Default:Linkspeed_and_FIFO_Queue_Bytes;70;Link_Type;Manual;Link_Speed;0;Queue_Length;64000;Overhead;18;Congestion_PCT;0.0;TTL_Cost;0;" ')
+ROUTE_TEMPLATE = (b'Routes[%d].Route_Disabled;0;Routes[%d].Port_In;Virtual;Routes[%d].Port_Out;%s;'
+                  b'Routes[%d].Network_Mask;%s;Routes[%d].Network_Address;%s;')
+VLAN_PORT_TEMPLATE = (b'--portModule "Default:Hardware_VLAN_Routing;%s;VLAN_Interfaces[0].Interface_Name;%s.%s;'
+                      b'VLAN_Interfaces[0].Use_As_Default_Interface;False;VLAN_Interfaces[0].VLAN_Id;%s;'
+                      b'VLAN_Interfaces[0].Detag_Packets_on_Output;False"')
+IPV4_PORT_TEMPLATE = (b'--portModule "Default:Hardware_IPv4_Routing;%s.%s;IPv4_Interfaces[0].Netmask;%s;'
+                      b'IPv4_Interfaces[0].Interface_Name;%s;IPv4_Interfaces[0].Gateway;%s;'
+                      b'IPv4_Interfaces[0].Accept_Multicast_Traffic;No;IPv4_Interfaces[0].Address;%s;'
+                      b'IPv4_Interfaces[0].Use_DHCP_Relay;No"')
+# INE errors that clear up on their own given a moment, a port being held by an emulation that's
+# still stopping or by a VI that's still being amended
+RETRYABLE_ERRORS = [
+    re.compile(r'^--error "Port id \[\d+\] is in use in an emulation and so cannot be deleted"$'),
+    re.compile(r'^--error ".*: Cannot Open a connection to Input port \(.*\) - likely it\'s already in use"$'),
+]
+
+
+@lru_cache(maxsize=4096)
+def route_network(ip, mask):
+    # The encoded netmask and network address of a route, the same routes turn up on many VIs
+    net = ipaddress.ip_network(ip + '/' + mask, strict=False)
+    return str(net.netmask).encode(), str(net.network_address).encode()
+
+
+@lru_cache(maxsize=None)
+def record_pattern(width):
+    # Matches one record of width ; separated fields in an INE listing
+    return re.compile(';'.join(['([^;]*)'] * width) + '(?:;|$)')
+
+
+def quote_state(data, start, end, state):
+    # Carries (inside a double quoted value, last byte was an escaping backslash) on over
+    # data[start:end]. Inside quotes \" and \\ are escapes, as OPTION_PATTERN reads them
+    in_quotes, escaped = state
+    position = start
+    if escaped:
+        if start >= end:
+            return state
+        position += 1
+    for match in QUOTE_PATTERN.finditer(data, position, end):
+        found = match.start()
+        if found < position:
+            continue
+        if data[found] == 34:
+            in_quotes = not in_quotes
+            position = found + 1
+        elif in_quotes:
+            if found + 1 >= end:
+                return in_quotes, True
+            position = found + 2
+    return in_quotes, False
+
+
+def send_parts(sock, parts):
+    # sendall for a list of buffers, written with sendmsg so they needn't be joined into one
+    # first. Where sendmsg isn't available (Windows) they're joined after all
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b''.join(parts))
+        return
+    views = [memoryview(part) for part in parts if len(part)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][sent:]
+
+
+class ResponseReader:
+    # Replies from the INE are a single line, so a reply is complete once the last byte received
+    # is a newline that isn't inside a quoted value. Data is read straight into a preallocated
+    # buffer which is reused for every reply on the connection and only grows by doubling
+    def __init__(self, size=65536, max_retained=1048576):
+        self.size = size
+        self.max_retained = max_retained
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.last_length = 0
+
+    def read(self, sock):
+        # Returns the decoded reply and whether the INE closed the connection
+        length = 0
+        state = (False, False)
+        while True:
+            if length == len(self.buffer):
+                self._resize(len(self.buffer) * 2, length)
+            received = sock.recv_into(self.view[length:])
+            if not received:
+                return self._result(length), True
+            state = quote_state(self.buffer, length, length + received, state)
+            length += received
+            if self.buffer[length - 1] == 10 and not state[0]:
+                return self._result(length), False
+
+    def _result(self, length):
+        self.last_length = length
+        result = str(self.view[:length], 'utf-8')
+        if len(self.buffer) > self.max_retained:
+            # Don't hold on to the memory from one unusually large reply
+            self._resize(self.size, 0)
+        return result
+
+    def _resize(self, size, keep):
+        buffer = bytearray(size)
+        buffer[:keep] = self.view[:keep]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = ResponseReader()
+        self.created = self.last_used = time.monotonic()
+
+    def isAlive(self):
+        # A healthy idle connection has nothing waiting to be read. If the socket is readable
+        # then either the INE closed it (recv returns b'') or there is a stale reply left on it,
+        # and in both cases it can't be reused
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError as ex:
+            print(ex)
 
-from credentials import itrinegyCredentials
 
+class ConnectionPool:
+    def __init__(self, factory, maxsize=4, idle_timeout=60.0):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "evictions": 0}
+        self._idle = deque()
+        self._lock = threading.Lock()
+        # Bounds the number of connections open at any one time, idle or in use
+        self._slots = threading.BoundedSemaphore(maxsize)
 
-class IT:
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    break
+                if time.monotonic() - conn.last_used > self.idle_timeout or not conn.isAlive():
+                    # Too old or closed by the INE, throw it away and try the next one
+                    conn.close()
+                    self._count("evictions")
+                    continue
+                self._count("hits")
+                return conn
+            self._count("misses")
+            return Connection(self.factory())
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def discard(self, conn):
+        conn.close()
+        self._slots.release()
+
+    def warm(self, count):
+        # Open connections ahead of time so the first commands don't pay for the handshake
+        conns = []
+        try:
+            for _ in range(min(count, self.maxsize)):
+                conns.append(self.acquire())
+        finally:
+            for conn in conns:
+                self.release(conn)
+
+    def reconnected(self):
+        self._count("reconnects")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn in idle:
+            conn.close()
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+class ProcModule:
+    # One procModule string from a VI's settings, e.g. "Default:Random_Delay;50;Min_Delay;10.0;Max_Delay;10.1;",
+    # which is library:name;order followed by key;value pairs. Nothing is parsed until it's first asked for
+    __slots__ = ("raw", "_library", "_name", "_order", "_params")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._name = None
+        self._params = None
+
+    @property
+    def library(self):
+        self._parseHeader()
+        return self._library
+
+    @property
+    def name(self):
+        self._parseHeader()
+        return self._name
+
+    @property
+    def order(self):
+        self._parseHeader()
+        return self._order
+
+    @property
+    def params(self):
+        if self._params is None:
+            fields = self.raw.split(';')[2:]
+            self._params = dict(zip(fields[0::2], fields[1::2]))
+        return self._params
+
+    def get(self, key, default=None):
+        return self.params.get(key, default)
+
+    def __getitem__(self, key):
+        return self.params[key]
+
+    def routes(self):
+        # Routes[n].Field;value pairs gathered into one dict per route, in route order
+        routes = {}
+        for key, value in self.params.items():
+            if key.startswith('Routes['):
+                number, field = key[7:].split('].', 1)
+                routes.setdefault(int(number), {})[field] = value
+        return [routes[number] for number in sorted(routes)]
+
+    def _parseHeader(self):
+        if self._name is None:
+            header = self.raw.split(';', 2)
+            self._library, _, self._name = header[0].rpartition(':')
+            self._order = int(header[1]) if len(header) > 1 and header[1].isdigit() else None
+
+    def _key(self):
+        # Modules are equal when they'd configure the same thing, whatever order the params are in
+        return self.library, self.name, self.order, frozenset(self.params.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, ProcModule):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "ProcModule(" + repr(self.raw) + ")"
+
+
+class ProcModules(list):
+    # The procModule strings of a VI. It's still a plain list of strings to anything that serialises
+    # it, but modules can be looked up by name, e.g. vi["procModule"].module("Random_Delay")
+    __slots__ = ("_modules", "_index")
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._modules = None
+        self._index = None
+
+    def modules(self):
+        if self._modules is None or len(self._modules) != len(self):
+            self._modules = [ProcModule(raw) for raw in self]
+            self._index = None
+        return self._modules
+
+    def module(self, name):
+        # Accepts the name with or without its library, e.g. "Random_Delay" or "Default:Random_Delay"
+        modules = self.modules()
+        if self._index is None:
+            self._index = {}
+            for module in modules:
+                self._index.setdefault(module.name, module)
+                self._index.setdefault(module.library + ':' + module.name, module)
+        return self._index.get(name)
+
+
+class RetryPolicy:
+    # Retries a command while its reply matches one of the retryable error patterns, backing off
+    # exponentially with full jitter, and gives up once the deadline or max_attempts is reached.
+    # Other replies, good or bad, are returned straight away
+    def __init__(self, retryable=RETRYABLE_ERRORS, base_delay=0.05, max_delay=2.0, deadline=10.0, max_attempts=None):
+        self.retryable = retryable
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.stats = {"calls": 0, "attempts": 0,
+                      "retries": 0, "gave_up": 0, "waited": 0.0}
+        self._lock = threading.Lock()
+
+    def isRetryable(self, result):
+        return isinstance(result, str) and any(pattern.match(result) for pattern in self.retryable)
+
+    def run(self, attempt):
+        started = time.monotonic()
+        attempts = 0
+        while True:
+            result = attempt()
+            attempts += 1
+            wait = self._nextWait(result, started, attempts)
+            if wait is None:
+                return result
+            time.sleep(wait)
+
+    async def runAsync(self, attempt):
+        # Same as run for a coroutine function, without blocking the event loop while waiting
+        started = time.monotonic()
+        attempts = 0
+        while True:
+            result = await attempt()
+            attempts += 1
+            wait = self._nextWait(result, started, attempts)
+            if wait is None:
+                return result
+            await asyncio.sleep(wait)
+
+    def _nextWait(self, result, started, attempts):
+        # How long to wait before trying again, or None to stop and return result
+        retry = self.isRetryable(result)
+        with self._lock:
+            if attempts == 1:
+                self.stats["calls"] += 1
+            self.stats["attempts"] += 1
+            if not retry:
+                return None
+            remaining = self.deadline - (time.monotonic() - started)
+            if remaining <= 0 or (self.max_attempts is not None and attempts >= self.max_attempts):
+                self.stats["gave_up"] += 1
+                return None
+            wait = min(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1))), remaining)
+            self.stats["retries"] += 1
+            self.stats["waited"] += wait
+            return wait
+
+
+class Metrics:
+    # Per command verb (getVISettings, procModule, addVi...) latency histograms, bytes on the wire
+    # and error counts, along with the pool, session and retry counters of the client. Hooks are
+    # called with every command's event dict, and everything can be exported as a JSON friendly
+    # snapshot or in the Prometheus text format
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.commands = {}
+        self.sources = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        self.hooks.remove(hook)
+
+    def verb(self, command):
+        if isinstance(command, (bytes, bytearray)):
+            # Only the start of a prebuilt command is decoded, the verb always comes early on
+            for match in VERB_BYTES_PATTERN.finditer(command, 0, 256):
+                if match.group(1).decode() not in SELECTOR_OPTIONS:
+                    return match.group(1).decode()
+            return "unknown"
+        for match in VERB_PATTERN.finditer(command):
+            if match.group(1) not in SELECTOR_OPTIONS:
+                return match.group(1)
+        return "unknown"
+
+    def record(self, event):
+        # event holds the verb, duration in seconds, bytes sent and received, reconnects and
+        # whether the INE replied with an error
+        with self._lock:
+            stats = self.commands.get(event["verb"])
+            if stats is None:
+                stats = self.commands[event["verb"]] = {
+                    "count": 0, "sum": 0.0, "buckets": [0] * (len(self.BUCKETS) + 1),
+                    "errors": 0, "sent": 0, "received": 0, "reconnects": 0}
+            stats["count"] += 1
+            stats["sum"] += event["duration"]
+            stats["buckets"][next((i for i, bound in enumerate(self.BUCKETS) if event["duration"] <= bound),
+                                  len(self.BUCKETS))] += 1
+            stats["errors"] += 1 if event["error"] else 0
+            stats["sent"] += event["sent"]
+            stats["received"] += event["received"]
+            stats["reconnects"] += event["reconnects"]
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as ex:
+                print("Metrics hook failed:", ex)
+
+    def snapshot(self):
+        with self._lock:
+            commands = {}
+            for verb, stats in self.commands.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.BUCKETS + ("+Inf",), stats["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                commands[verb] = dict(stats, buckets=buckets)
+        snapshot = {"commands": commands}
+        for name, source in self.sources.items():
+            snapshot[name] = dict(source())
+        return snapshot
+
+    def prometheus(self, prefix="itrinegy"):
+        snapshot = self.snapshot()
+        lines = ["# TYPE " + prefix + "_command_duration_seconds histogram"]
+        for verb, stats in sorted(snapshot["commands"].items()):
+            for bound, count in stats["buckets"].items():
+                lines.append(prefix + '_command_duration_seconds_bucket{verb="' + verb + '",le="' + bound + '"} ' + str(count))
+            lines.append(prefix + '_command_duration_seconds_sum{verb="' + verb + '"} ' + repr(stats["sum"]))
+            lines.append(prefix + '_command_duration_seconds_count{verb="' + verb + '"} ' + str(stats["count"]))
+        for name, key in (("command_errors", "errors"), ("bytes_sent", "sent"), ("bytes_received", "received"),
+                          ("command_reconnects", "reconnects")):
+            lines.append("# TYPE " + prefix + "_" + name + "_total counter")
+            for verb, stats in sorted(snapshot["commands"].items()):
+                lines.append(prefix + "_" + name + '_total{verb="' + verb + '"} ' + str(stats[key]))
+        for source in sorted(self.sources):
+            for key, value in sorted(snapshot[source].items()):
+                lines.append("# TYPE " + prefix + "_" + source + "_" + key + "_total counter")
+                lines.append(prefix + "_" + source + "_" + key + "_total " + repr(value))
+        return "\n".join(lines) + "\n"
+
+
+class SessionManager:
+    # Owns the INE user session for a client. Only one thread logs in at a time: when a session
+    # expires the first caller to report it logs in again and everyone else waits for that login
+    # rather than starting their own. Sessions can also be refreshed before the INE expires them,
+    # once they're older than max_age or have been idle longer than max_idle seconds
+    def __init__(self, login, max_age=None, max_idle=None):
+        self.login = login
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.session_id = ""
+        self.stats = {"logins": 0, "expiries": 0, "refreshes": 0}
+        self._created = self._last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def current(self):
+        # The session to send a command with, logging in first if there isn't a usable one
+        session_id = self.session_id
+        if not session_id or self._stale():
+            with self._lock:
+                if self.session_id == session_id:
+                    if session_id:
+                        self.stats["refreshes"] += 1
+                    self._renew()
+                session_id = self.session_id
+        self._last_used = time.monotonic()
+        return session_id
+
+    def expired(self, session_id):
+        # The INE has rejected session_id. Log in again unless another thread already has
+        with self._lock:
+            if self.session_id == session_id:
+                self.stats["expiries"] += 1
+                print("User session expired, fetching another one...")
+                self._renew()
+            return self.session_id
+
+    def renew(self):
+        with self._lock:
+            self._renew()
+            return self.session_id
+
+    def _stale(self):
+        now = time.monotonic()
+        return (self.max_age is not None and now - self._created > self.max_age) or \
+            (self.max_idle is not None and now - self._last_used > self.max_idle)
+
+    def _renew(self):
+        self.session_id = self.login()
+        self.stats["logins"] += 1
+        self._created = self._last_used = time.monotonic()
+
+
+class PortTable:
+    # Index over one --getAllPorts snapshot: ports by id and by name (the address for IPv4 ports)
+    # plus each port's children, keeping the order the INE listed them in. Treat it as read-only,
+    # without() gives a new table rather than changing this one
+    def __init__(self, ports):
+        self.ports = ports
+        self.by_id = {}
+        self.by_name = {}
+        self.children = {}
+        # Names more than one port has, the first listed is the one by_name gives
+        self.shared = set()
+        for port in ports:
+            self.by_id[port["id"]] = port
+            if self.by_name.setdefault(port["name"], port) is not port:
+                self.shared.add(port["name"])
+            if port["parent"] is not None:
+                self.children.setdefault(port["parent"], []).append(port)
+
+    def __iter__(self):
+        return iter(self.ports)
+
+    def __len__(self):
+        return len(self.ports)
+
+    def __contains__(self, portId):
+        return int(portId) in self.by_id
+
+    def get(self, portId):
+        return self.by_id.get(int(portId))
+
+    def getByName(self, name):
+        return self.by_name.get(str(name))
+
+    def getParent(self, portId):
+        port = self.get(portId)
+        if port is not None and port["parent"] is not None:
+            return self.by_id.get(port["parent"])
+        return None
+
+    def getChildren(self, portId):
+        return list(self.children.get(int(portId), []))
+
+    def getSubtree(self, portId):
+        # The port followed by all of its descendants, every parent coming before its children
+        port = self.get(portId)
+        if port is None:
+            return []
+        subtree = [port]
+        for port in subtree:
+            subtree.extend(self.children.get(port["id"], []))
+        return subtree
+
+    def without(self, portId):
+        # Copies the indexes and takes the port out of them, rather than indexing every port again
+        port = self.get(portId)
+        if port is None:
+            return self
+        table = PortTable([])
+        table.by_id = dict(self.by_id)
+        del table.by_id[port["id"]]
+        # by_id is in the order the INE listed the ports
+        table.ports = list(table.by_id.values())
+        table.by_name = dict(self.by_name)
+        table.shared = self.shared
+        if table.by_name.get(port["name"]) is port:
+            del table.by_name[port["name"]]
+            if port["name"] in self.shared:
+                # Another port with the same name takes its place
+                other = next((d for d in table.ports if d["name"] == port["name"]), None)
+                if other is not None:
+                    table.by_name[port["name"]] = other
+        table.children = dict(self.children)
+        if port["parent"] is not None and port["parent"] in table.children:
+            table.children[port["parent"]] = [d for d in table.children[port["parent"]] if d is not port]
+        return table
+
+
+class SnapshotCache:
+    # Holds whole listings from the INE (ports, running emulations) for up to ttl seconds so repeated
+    # reads don't round-trip. Writes that change a listing either update the snapshot in place or
+    # invalidate it. A ttl of 0 turns caching off
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, refresh=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+        if not refresh and entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        loaded = time.monotonic()
+        value = loader()
+        with self._lock:
+            # Don't store a listing that was invalidated while we were fetching it
+            if generation == self._generation and value is not None:
+                self._entries[key] = (loaded, value)
+        return value
+
+    def put(self, key, value):
+        # Seed a snapshot loaded from somewhere other than the INE, e.g. a SnapshotStore
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+    def update(self, key, func):
+        # Apply a known change to the snapshot without refetching it
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], func(entry[1]))
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class SnapshotStore:
+    # SQLite file holding the last parsed emulation listing, port table and VI settings of each
+    # appliance, so a restarted process can answer from them straight away while it revalidates.
+    # VI settings are stored per emulation along with the emulation's update time, and are only
+    # used while the INE still reports that update time. One process should write to the store,
+    # any others on the host can open it with read_only and share it
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        if read_only:
+            self.db = sqlite3.connect("file:" + path + "?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            # WAL lets readers in other processes carry on while we write
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (appliance TEXT, key TEXT, version TEXT, "
+                            "stored REAL, value TEXT, PRIMARY KEY (appliance, key))")
+            self.db.commit()
+        self._lock = threading.Lock()
+
+    def load(self, appliance, key):
+        # (version, value) as last saved, or None
+        with self._lock:
+            try:
+                row = self.db.execute("SELECT version, value FROM snapshots WHERE appliance = ? AND key = ?",
+                                      (appliance, key)).fetchone()
+            except sqlite3.Error as ex:
+                print("Unable to read the snapshot store:", ex)
+                return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def save(self, appliance, key, value, version=None):
+        if self.read_only:
+            return
+        with self._lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                                (appliance, key, version, time.time(), json.dumps(value)))
+                self.db.commit()
+            except sqlite3.Error as ex:
+                print("Unable to write to the snapshot store:", ex)
+
+    def forget(self, appliance, key=None):
+        if self.read_only:
+            return
+        with self._lock:
+            try:
+                if key is None:
+                    self.db.execute("DELETE FROM snapshots WHERE appliance = ?", (appliance,))
+                else:
+                    self.db.execute("DELETE FROM snapshots WHERE appliance = ? AND key = ?", (appliance, key))
+                self.db.commit()
+            except sqlite3.Error as ex:
+                print("Unable to write to the snapshot store:", ex)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class BaseIT:
+    # Everything about talking to the INE that doesn't need the network: reply parsing,
+    # emulation layout and command building. Shared by IT and AsyncIT
     def __init__(self, ipstr, port, username, password):
         self.ipstr = ipstr
         self.port = port
         self.username = username
         self.password = password
-        self.session = socket.socket()
-        self.session_id = ""
         self.emulation_settings = {
             "object_wh": 80,
             "width": 1900,
@@ -25,101 +732,630 @@ class IT:
             "gw_distance": 300
         }
 
-    def connect(self):
+    def parseEmulations(self, result):
+        # result will be --emulations "num emulations;emul name;emulation running;emulation notes;default emulation;username;start time;update time..."
+        return list(self.streamEmulations(result))
+
+    def parsePorts(self, result):
+        return list(self.streamPorts(result))
+
+    def streamRecords(self, result, width):
+        # The records in a reply's quoted value, a count followed by width ; separated fields for
+        # each record, matched one record at a time rather than split into a list of every field
+        start = result.index(' ') + 1
+        end = len(result)
+        # kill off double and single quote chars from front and back
+        while start < end and result[start] in '"\'':
+            start += 1
+        while end > start and result[end - 1] in '"\'':
+            end -= 1
+        stop = result.find(';', start, end)
+        count = int(result[start:stop if stop != -1 else end])
+        if count:
+            for number, match in zip(range(count), record_pattern(width).finditer(result, stop + 1, end)):
+                yield match.groups()
+
+    def streamEmulations(self, result):
+        # Yields the emulations in a --emulations reply one at a time
+        for parts in self.streamRecords(result, 8):
+            yield {"id": int(parts[0]), "name": parts[1], "updated": parts[7]}
+
+    def streamPorts(self, result):
+        # Yields the ports in a --ports reply one at a time
+        for parts in self.streamRecords(result, 6):
+            yield {"id": int(parts[0]),
+                   "name": parts[1],
+                   "parent": int(parts[2]) if parts[2] != "-1" else None,
+                   "type": parts[4],
+                   "subtype": parts[5] if parts[5] != "" else None
+                   }
+
+    def parseViIds(self, result):
+        # separate --VIsForEmulation from the result data
+        header, data = result.split(' ', 1)
+        # kill off double and single quote chars from front and back
+        data = data.strip('"\'')
+        # create an array of the ; separated items
+        vi_Ids = data.split(';')
+        # Remove the last one as it's just a blank line
+        vi_Ids.pop(len(vi_Ids)-1)
+        # Remove the first as that is also just rubbish
+        vi_Ids.pop(0)
+        return vi_Ids
+
+    def parseViSettings(self, result):
+        # A single pass over the --key "value" pairs in the reply. procModule repeats so it's
+        # collected into a list, any other key keeps its last value, including keys we don't know about
+        if result.startswith('--error'):
+            return None
+        full_list = defaultdict(list)
+        for key, quoted, single, bare in OPTION_PATTERN.findall(result):
+            if quoted:
+                value = ESCAPE_PATTERN.sub(r'\1', quoted) if '\\' in quoted else quoted
+            else:
+                value = single or bare
+            if key == "procModule":
+                full_list.setdefault(key, ProcModules()).append(value)
+            else:
+                full_list[key] = value
+        return full_list
+
+    def procModulesOf(self, vi):
+        modules = vi.get('procModule', [])
+        return modules if isinstance(modules, ProcModules) else ProcModules(modules)
+
+    def latencyFromVi(self, vi):
+        latency = self.procModulesOf(vi).module('Default:Random_Delay')
+        if latency is None or latency.get('Min_Delay') is None:
+            return {"latency": 0}
+        else:
+            return {"latency": int(float(latency['Min_Delay']))*2}
+
+    def lossFromVi(self, vi):
+        loss = self.procModulesOf(vi).module('Default:Random_Drop')
+        if loss is None or loss.get('Loss_Percent') is None:
+            return {"loss": 0}
+        else:
+            return {"loss": int(float(loss['Loss_Percent']))*2}
+
+    def errorsFromVi(self, vi):
+        errors = self.procModulesOf(vi).module('Default:Random_Packet_Corrupt')
+        if errors is None or errors.get('Packet_Corruption_Percent') is None:
+            return {"errors": 0}
+        else:
+            return {"errors": int(float(errors['Packet_Corruption_Percent']))*2}
+
+    def impairmentsFromVi(self, vi):
+        # Pull every impairment out of one set of VI settings rather than fetching it per impairment
+        return {
+            "latency": self.latencyFromVi(vi)["latency"],
+            "loss": self.lossFromVi(vi)["loss"],
+            "errors": self.errorsFromVi(vi)["errors"]
+        }
+
+    def latencyModule(self, latency_value):
+        return '--procModule "Default:Random_Delay;50;Min_Delay;' + \
+            str(latency_value) + ';Max_Delay;' + \
+            str(latency_value+0.1) + ';"'
+
+    def lossModule(self, loss_percent):
+        return '--procModule "Default:Random_Drop;30;Loss_Percent;' + \
+            str(loss_percent) + ';"'
+
+    def errorsModule(self, error_percent):
+        return '--procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;' + \
+            str(error_percent) + ';"'
+
+    def latencyCommand(self, vi_id, latency_value):
+        return '--Id ' + str(vi_id) + ' ' + self.latencyModule(latency_value)
+
+    def lossCommand(self, vi_id, loss_percent):
+        return '--Id ' + str(vi_id) + ' ' + self.lossModule(loss_percent)
+
+    def errorsCommand(self, vi_id, error_percent):
+        return '--Id ' + str(vi_id) + ' ' + self.errorsModule(error_percent)
+
+    def impairmentsCommand(self, vi_id, latency=None, loss=None, errors=None):
+        # The INE takes several procModules in one command, so any mix of impairments for a VI
+        # can go in a single round-trip. Values are halved as the INE applies them in both
+        # directions. Returns the command and the impairments it will apply
+        modules = []
+        applied = {}
+        if latency is not None:
+            modules.append(self.latencyModule(latency/2))
+            applied['latency'] = latency/2*2
+        if loss is not None:
+            modules.append(self.lossModule(loss/2))
+            applied['loss'] = loss/2*2
+        if errors is not None:
+            modules.append(self.errorsModule(errors/2))
+            applied['errors'] = errors/2*2
+        return '--Id ' + str(vi_id) + ' ' + ' '.join(modules), applied
+
+    def portCommands(self, interface, vlan, address, mask, gateway):
+        # Built straight to bytes, sendCommand passes them through to the socket
+        interface, vlan, address = str(interface).encode(), str(vlan).encode(), str(address).encode()
+        vlan_command = VLAN_PORT_TEMPLATE % (interface, interface, vlan, vlan)
+        ipv4_command = IPV4_PORT_TEMPLATE % (
+            interface, vlan, str(mask).encode(), address, str(gateway).encode() if gateway is not None else b'', address)
+        return vlan_command, ipv4_command
+
+    def planPorts(self, ports, desired, prune=False):
+        # Diff the WAN ports we want, (wan, vlan, address, mask, gateway) entries or dicts with those
+        # keys, against one PortTable snapshot. Steps come out in the order they must be applied:
+        # IPv4 ports then VLANs are deleted, then VLANs then IPv4 ports created. Ports on a VLAN
+        # other than the wanted one are recreated, prune also deletes ports nobody asked for
+        plan = {"delete_ipv4": [], "delete_vlan": [], "create_vlan": [], "create_ipv4": [],
+                "unchanged": [], "invalid": []}
+        wanted = {}
+        for entry in desired:
+            if not isinstance(entry, dict):
+                entry = dict(zip(("wan", "vlan", "address", "mask", "gateway"), entry))
+            entry = dict({"mask": "255.255.255.252", "gateway": None}, **entry)
+            try:
+                interface = self.wanInterface(int(entry["wan"]))
+            except (TypeError, ValueError):
+                interface = None
+            if interface is None:
+                plan["invalid"].append(dict(entry, reason="no such WAN"))
+                continue
+            entry["interface"] = interface
+            entry["vlan_name"] = str(interface) + "." + str(entry["vlan"])
+            wanted[str(entry["address"])] = entry
+
+        deleted = set()
+        vlans = set()
+        for address, entry in wanted.items():
+            port = ports.getByName(address)
+            parent = ports.getParent(port["id"]) if port is not None else None
+            if port is not None and parent is not None and parent["name"] == entry["vlan_name"]:
+                plan["unchanged"].append({"name": address, "id": port["id"]})
+                continue
+            if port is not None:
+                plan["delete_ipv4"].append({"name": address, "id": port["id"], "reason": "vlan changed"})
+                deleted.add(port["id"])
+            vlan = ports.getByName(entry["vlan_name"])
+            if vlan is None and entry["vlan_name"] not in vlans:
+                vlans.add(entry["vlan_name"])
+                plan["create_vlan"].append({"name": entry["vlan_name"], "interface": entry["interface"],
+                                            "vlan": entry["vlan"]})
+            plan["create_ipv4"].append({"name": address, "interface": entry["interface"], "vlan": entry["vlan"],
+                                        "mask": entry["mask"], "gateway": entry["gateway"],
+                                        "reason": "vlan changed" if port is not None else "missing"})
+
+        # VLANs under the WAN interfaces that end up with no ports on them go too, unless wanted
+        wanted_vlans = {entry["vlan_name"] for entry in wanted.values()}
+        for interface in (self.wanInterface(1), self.wanInterface(2)):
+            hardware = ports.getByName(interface)
+            if hardware is None:
+                continue
+            for vlan in ports.getChildren(hardware["id"]):
+                children = ports.getChildren(vlan["id"])
+                if prune:
+                    for port in children:
+                        if port["name"] not in wanted and port["id"] not in deleted:
+                            plan["delete_ipv4"].append({"name": port["name"], "id": port["id"], "reason": "orphan"})
+                            deleted.add(port["id"])
+                emptied = children and all(port["id"] in deleted for port in children)
+                if vlan["name"] not in wanted_vlans and (emptied or (prune and not children)):
+                    plan["delete_vlan"].append({"name": vlan["name"], "id": vlan["id"], "reason": "orphan"})
+        return plan
+
+    def describePlan(self, plan):
+        # One line per step of a planPorts plan, in the order they'd be applied
+        lines = []
+        for phase in ("delete_ipv4", "delete_vlan", "create_vlan", "create_ipv4"):
+            action, kind = phase.split("_")
+            for step in plan[phase]:
+                line = action + " " + ("VLAN" if kind == "vlan" else "IPv4") + " port " + step["name"]
+                if "id" in step:
+                    line += " (id " + str(step["id"]) + ")"
+                if step.get("reason"):
+                    line += ": " + step["reason"]
+                lines.append(line)
+        for step in plan["invalid"]:
+            lines.append("skip " + str(step["address"]) + ": " + step["reason"])
+        lines.append(str(len(plan["unchanged"])) + " ports already correct")
+        return lines
+
+    def planEmulation(self, product, devices):
+        # Work out where every object goes and which routes it needs, returns the FW, Outer,
+        # Internet and MPLS VIs followed by the list of device VIs
+        # Instantiate the FW
+        FW_Vi = {"name": "Firewall",
+                 "xpos": ((self.emulation_settings["width"]/2)-self.emulation_settings["object_wh"]/2),
+                 "ypos": self.emulation_settings["height"]-280,
+                 # Add the product gateway IP
+                 "address": ipaddress.ip_address(product.gateway_ip)+1,
+                 "mask": "255.255.255.252",
+                 "gateway": ipaddress.ip_address(product.gateway_ip),
+                 "vlan": product.vlan.vlan,
+                 "number": 1}  # Set a FW port to 1
+
+        # Instantiate the Outer VI
+        Outer_Vi = {"name": "Outer",
+                    "xpos": FW_Vi["xpos"],
+                    "ypos": FW_Vi["ypos"]-100,
+                    "routes": []}
+
+        # Instantiate the Internet VI
+        Internet_Vi = {"name": "Internet",
+                       "xpos": Outer_Vi["xpos"]-self.emulation_settings["gw_distance"],
+                       "ypos": Outer_Vi["ypos"]-150,
+                       "routes": []}
+
+        # Instantiate the MPLS VI
+        MPLS_Vi = {"name": "MPLS",
+                   "xpos": Outer_Vi["xpos"]+self.emulation_settings["gw_distance"],
+                   "ypos": Outer_Vi["ypos"]-150,
+                   "routes": []}
+
+        # Define the link to add at the end
+        FW_Vi["parent"] = Outer_Vi["name"] + " Link: " + \
+            FW_Vi["name"] + " --> " + Outer_Vi["name"]
+
+        ### Build the devices ###
+        wan1_positions = {"xpos": Internet_Vi["xpos"] - 210,
+                          "ypos": 220}
+        wan2_positions = {"xpos": MPLS_Vi["xpos"] + 210,
+                          "ypos": 220}
+        device_vis = []
+        for device in devices:
+            if device.wan1 is not None:
+                Device_Vi = {}  # Create the dict before we can use it
+                Device_Vi["number"] = 1
+                Device_Vi["gateway"] = str(
+                    ipaddress.ip_address(device.wan1.address.address))
+                Device_Vi["address"] = str(
+                    ipaddress.ip_address(device.wan1.address.address)-1)
+                Device_Vi["mask"] = str(ipaddress.ip_network(
+                    device.wan1.address.address + "/" + str(device.wan1.address.mask), strict=False).netmask)
+                Device_Vi["vlan"] = device.wan1.vlan.vlan
+                Device_Vi["name"] = device.name + '-GW0'
+                Device_Vi["type"] = "device"
+
+                Device_Vi["xpos"] = wan1_positions["xpos"]
+                Device_Vi["ypos"] = wan1_positions["ypos"]
+                Device_Vi["parent"] = "Internet"
+                Internet_Vi["routes"].append(
+                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Device_Vi["name"]})
+                Outer_Vi["routes"].append(
+                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Internet_Vi["name"] + ' Link: ' + Outer_Vi["name"] + " --> " + Internet_Vi["name"]})
+                # Move the next object down
+                wan1_positions["ypos"] += self.emulation_settings["object_wh"] + \
+                    self.emulation_settings["object_wh"]/4
+                device_vis.append(Device_Vi)
+
+            if device.wan2 is not None:
+                Device_Vi = {}  # Create the dict before we can use it
+                Device_Vi["number"] = 2
+                Device_Vi["gateway"] = str(
+                    ipaddress.ip_address(device.wan2.address.address))
+                Device_Vi["address"] = str(
+                    ipaddress.ip_address(device.wan2.address.address)-1)
+                Device_Vi["mask"] = str(ipaddress.ip_network(
+                    device.wan2.address.address + "/" + str(device.wan2.address.mask), strict=False).netmask)
+                Device_Vi["vlan"] = device.wan2.vlan.vlan
+                Device_Vi["name"] = device.name + '-GW1'
+                Device_Vi["type"] = "device"
+
+                Device_Vi["xpos"] = wan2_positions["xpos"]
+                Device_Vi["ypos"] = wan2_positions["ypos"]
+                Device_Vi["parent"] = "MPLS"
+                MPLS_Vi["routes"].append(
+                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Device_Vi["name"]})
+                Outer_Vi["routes"].append(
+                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": MPLS_Vi["name"] + ' Link: ' + Outer_Vi["name"] + " --> " + MPLS_Vi["name"]})
+                # Move the next object down
+                wan2_positions["ypos"] += self.emulation_settings["object_wh"] + \
+                    self.emulation_settings["object_wh"]/4
+                device_vis.append(Device_Vi)
 
+        Internet_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": Internet_Vi["name"] +
+                                      ' Link: ' + Internet_Vi["name"] + " --> " + Outer_Vi["name"]})
+        MPLS_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": MPLS_Vi["name"] +
+                                  ' Link: ' + MPLS_Vi["name"] + " --> " + Outer_Vi["name"]})
+        Outer_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": Outer_Vi["name"] +
+                                   ' Link: ' + Outer_Vi["name"] + " --> " + FW_Vi["name"]})
+        return FW_Vi, Outer_Vi, Internet_Vi, MPLS_Vi, device_vis
+
+    def summarizeRoutes(self, routes):
+        # Merge the routes that share a portOut into the fewest covering networks with
+        # ipaddress.collapse_addresses. This assumes the INE picks a route by longest prefix match,
+        # not by taking the first route that matches, since merging moves routes about: each merged
+        # network takes the place of the first route it covers. A merged network is only used if no
+        # route to a different portOut falls inside it, as that route could then win or tie where
+        # it used to lose, so every address still goes where it went before. benchmark.py checks
+        # this on random route sets. Returns the new routes and how many went
+        networks = []
+        for route in routes:
+            networks.append(ipaddress.ip_network(route["ip"] + '/' + route["mask"], strict=False))
+        groups = {}
+        for number, route in enumerate(routes):
+            groups.setdefault(route["portOut"], []).append(number)
+
+        replacements = {}
+        for portOut, members in groups.items():
+            if len(members) == 1:
+                replacements[members[0]] = networks[members[0]]
+                continue
+            for network in ipaddress.collapse_addresses(networks[number] for number in members):
+                covered = [number for number in members if networks[number].subnet_of(network)]
+                if len(covered) > 1 and any(
+                        routes[number]["portOut"] != portOut and networks[number].version == network.version and
+                        networks[number].subnet_of(network) for number in range(len(routes))):
+                    # Keep the routes as they were, less exact duplicates
+                    unique = {}
+                    for number in covered:
+                        unique.setdefault(networks[number], number)
+                    for kept, number in unique.items():
+                        replacements[number] = kept
+                else:
+                    replacements[min(covered)] = network
+
+        summarized = []
+        for number in sorted(replacements):
+            network = replacements[number]
+            summarized.append({"ip": str(network.network_address), "mask": str(network.netmask),
+                               "portOut": routes[number]["portOut"]})
+        return summarized, len(routes) - len(summarized)
+
+    def planLinks(self, from_vi, to_vi):
+        # Lays out the pair of line objects joining two VIs, they still need creating on the INE
+        link_name = from_vi["name"] + " Link"
+        links = [
+            {"name": link_name + ': ' +
+                from_vi["name"] + ' --> ' + to_vi["name"], "parent": to_vi["name"]},
+            {"name": link_name + ': ' +
+                to_vi["name"] + ' --> ' + from_vi["name"], "parent": from_vi["name"]}
+        ]
+
+        xpos = int(from_vi["xpos"]) + (self.emulation_settings["object_wh"]/2)
+        ypos = int(from_vi["ypos"]) + (self.emulation_settings["object_wh"]/2)
+        width = int(to_vi["xpos"]) - int(from_vi["xpos"])
+        height = int(to_vi["ypos"]) - int(from_vi["ypos"])
+        objdir = 1
+        if width < 0:
+            width = abs(width)
+            xpos = int(to_vi["xpos"]) + \
+                (self.emulation_settings["object_wh"]/2)
+            objdir += 1
+        elif width == 0:
+            width = 2
+            xpos -= 5
+            objdir = 2
+        if height < 0:
+            height = abs(height)
+            ypos = int(to_vi["ypos"]) + \
+                (self.emulation_settings["object_wh"]/2)
+            objdir += 2
+        elif height == 0:
+            height = 2
+            ypos -= 5
+        vis = []
+        for link in links:
+            vis.append({"name": link["name"], "parent": link["parent"], "xpos": int(xpos), "ypos": int(
+                ypos), "width": int(width), "height": int(height), "objdir": objdir, "groupname": link_name})
+        return vis
+
+    def planObjectVi(self, vi):
+        vi["width"] = vi["height"] = self.emulation_settings["object_wh"]
+        if not vi.get("objdir"):
+            vi["objdir"] = 0
+        return vi
+
+    def encodeCommand(self, command, session_id=None):
+        # INE expects a new line to end the instruction and you must encode in 'utf-8' otherwise it
+        # won't work. Returns the pieces of the payload to be written out in turn, so a command
+        # built as bytes goes to the socket as it is rather than being copied in behind the session ID
+        if not isinstance(command, (bytes, bytearray)):
+            command = command.encode('utf-8')
+        if session_id is None:
+            return [command, b'\n']
+        return [session_id.encode('utf-8') + b' ', command, b'\n']
+
+    def amendCommand(self, vi):
+        # The constant procModules are already encoded, only the parts that vary by VI are encoded
+        # here, straight onto the end of the one buffer sendCommand writes to the socket
+        groupname = vi["name"]
+        vitype = b"picture"
+        command = bytearray(b'--id %s ' % str(vi["id"]).encode())
+        command += MANDATORY_PROCS_HEAD
+        # Apply routing depending on which type of object it is
+        if vi.get("address"):
+            address = str(vi["address"]).encode()
+            command += b'--procModule "Default:Symmetric_Routing;60;'
+            if vi.get("parent"):
+                command += b'Routes[0].Port_Out;%s;Routes[0].Port_In;%s;' % (vi["parent"].encode(), address)
+            command += b'Port_In;%s;Port_Out;%s;" ' % (address, address)
+            image = b'LAN/Port.png'
+        else:
+            image = b'Standard/Router.png'
+        if vi["objdir"] > 0:
+            command += b'--procModule "Default:Generic_Routing;60;Port_In;Virtual;Port_Out;%s;" ' % vi["parent"].encode()
+            image = b'Standard/FullDuplex.png'
+            groupname = vi["groupname"]
+            vitype = b"lineobject"
+        if vi.get("routes"):
+            command += b'--procModule "Default:IPv4_Routing;60;'
+            for routeNumber, route in enumerate(vi["routes"]):
+                netmask, network = route_network(route["ip"], route["mask"])
+                command += ROUTE_TEMPLATE % (routeNumber, routeNumber, routeNumber, route["portOut"].encode(),
+                                             routeNumber, netmask, routeNumber, network)
+            command += b'Port_In;;Port_Out;;" '
+
+        # Now for more mandatory procs
+        command += MANDATORY_PROCS_TAIL
+        if vitype == b"lineobject":
+            command += b'--procModule "Default:;80;" '
+        command += b'--vitype "%s" --groupname "%s" ' % (vitype, groupname.encode())
+        command += b'--xpos %s --ypos %s --width %s --height %s --objdir %s ' % (
+            str(vi["xpos"]).encode(), str(vi["ypos"]).encode(), str(vi["width"]).encode(),
+            str(vi["height"]).encode(), str(vi["objdir"]).encode())
+        command += b'--image "%s" --notes "" ' % image
+        return command
+
+    def noSuchPortError(self, vi):
+        # What amending a device VI returns when its port hasn't been created yet
+        return '--error "[' + vi["name"] + ' - Default:Symmetric_Routing]: Object ' + \
+            vi["name"] + ': No such port (' + str(vi["address"]) + ')"'
+
+    def wanInterface(self, wan_number):
+        if 1 <= wan_number <= 2:
+            if wan_number == 1:
+                return 0
+            elif wan_number == 2:
+                return 1
+        return None
+
+    def removeDashes(self, variable):
+        variable = variable.replace("--", "")
+        return variable
+
+
+class IT(BaseIT):
+    def __init__(self, ipstr, port, username, password, pool_size=4, idle_timeout=60.0, parallelism=4, cache_ttl=2.0,
+                 session_max_age=None, session_max_idle=None, store=None, timeout=30.0):
+        super().__init__(ipstr, port, username, password)
+        # Seconds to wait on the INE before giving up on a connection, so a reply that never
+        # completes can't block a worker forever
+        self.timeout = timeout
+        self.pool = ConnectionPool(self.connect, pool_size, idle_timeout)
+        self.sessions = SessionManager(
+            self.requestSession, session_max_age, session_max_idle)
+        self.cache = SnapshotCache(cache_ttl)
+        # An optional SnapshotStore that listings and VI settings are persisted to, see warmStart
+        self.store = store
+        self.appliance = str(ipstr) + ":" + str(port)
+        self.max_reconnects = 3
+        self.parallelism = parallelism
+        self.retry = RetryPolicy()
+        self.metrics = Metrics()
+        self.metrics.sources.update(pool=lambda: self.pool.stats,
+                                    sessions=lambda: self.sessions.stats,
+                                    retry=lambda: self.retry.stats)
+
+    def connect(self):
         try:
             # Create a TCP/IP socket
-            self.session = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
             # Connect the socket to the port where the server is listening
             server_address = (self.ipstr, self.port)
-            self.session.connect(server_address)
-
-        except:
-            # TODO: Throw Exception
+            sock.connect(server_address)
+        except OSError as ex:
             print("Socket or connection error while initiating contact with INE")
-            self.disconnect()
+            sock.close()
+            raise ConnectionError(ex)
+        return sock
 
     def disconnect(self):
-        try:
-            self.session.close()
-        except Exception as ex:
-            print(ex)
+        # Close every idle pooled connection, in use ones are closed as they come back
+        self.pool.close()
+
+    @property
+    def session_id(self):
+        return self.sessions.session_id
 
     def sendCommand(self, command, noSession=False, waitForClose=False):
-        self.connect()
+        # waitForClose is no longer needed as replies are framed by ResponseReader, it's kept so
+        # existing callers don't break
+        event = {"verb": self.metrics.verb(command), "sent": 0,
+                 "received": 0, "reconnects": 0, "error": True}
+        started = time.perf_counter()
+        try:
+            result = self._sendCommand(command, noSession, event)
+            event["error"] = result.startswith("--error")
+            return result
+        finally:
+            event["duration"] = time.perf_counter() - started
+            self.metrics.record(event)
+
+    def _sendCommand(self, command, noSession, event):
+        reconnects = 0
         while True:
-            # INE expects a new line to end the instruction and you must encode in 'utf-8' otherwise it won't work
+            if not noSession:
+                # Append the session ID to the command
+                session_id = self.sessions.current()
+                payload = self.encodeCommand(command, session_id)
+            else:
+                # Leave the session ID off
+                payload = self.encodeCommand(command)
+            conn = self.pool.acquire()
             try:
-                if not noSession:
-                    # Append the session ID to the command
-                    self.session.sendall(
-                        (self.session_id + ' ' + command + '\n').encode('utf-8'))
-                else:
-                    # Leave the session ID off
-                    self.session.sendall((command + '\n').encode('utf-8'))
-                # If function has requested waitForClose
-                if waitForClose:
-                    # Start with an empty data buffer
-                    data = b''
-                    while True:
-                        try:
-                            # Fill the chunk buffer with data received from the iTrinegy socket
-                            chunk = self.session.recv(200000)
-                            if not chunk:
-                                # If we stop receiving data, get out of the loop
-                                break
-                            # Otherwise add the chunk to the data buffer and go round again
-                            data += chunk
-                            # TODO: Fix this hideous check to ensure we've received all the data
-                            if str(chunk)[-3:] == '\\n\'':
-                                break
-                        except socket.error as ex:
-                            print(ex)
-                else:
-                    data = self.session.recv(1024)
-                # Tidy up the returned string into a readable format
-                result = str(data.decode('ascii').rstrip())
-                if "Unable to find user session" not in result:
-                    return result
-                    # Disconnect as per socket good practice
-                    self.disconnect()
-                    break
-                else:
-                    # Login and try again
-                    print("User session expired, fetching another one...")
-                    self.login()
-            except BrokenPipeError:
+                send_parts(conn.sock, payload)
+                event["sent"] += sum(len(part) for part in payload)
+                data, closed = conn.reader.read(conn.sock)
+                event["received"] += conn.reader.last_length
+                if not data and closed:
+                    # The INE dropped an idle connection before we got a reply
+                    raise BrokenPipeError
+            except (BrokenPipeError, ConnectionResetError):
                 # Reconnect and try again
-                self.connect()
+                self.pool.discard(conn)
+                self.pool.reconnected()
+                reconnects += 1
+                event["reconnects"] = reconnects
+                if reconnects > self.max_reconnects:
+                    raise
+                continue
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+            if closed:
+                self.pool.discard(conn)
+            else:
+                self.pool.release(conn)
+            # Tidy up the returned string into a readable format
+            result = data.rstrip()
+            if noSession or "Unable to find user session" not in result:
+                return result
+            # Login and try again, unless another thread has already done so
+            self.sessions.expired(session_id)
+
+    def fanOut(self, func, items, parallelism=None):
+        # Call func for every item on up to parallelism threads, returning the results in the same
+        # order as items. An item that raises gets {"id": item, "error": ...} in place of its result
+        # so one bad lookup doesn't fail the whole call
+        def call(item):
+            try:
+                return func(item)
+            except Exception as ex:
+                return {"id": item, "error": str(ex)}
+
+        items = list(items)
+        workers = min(parallelism or self.parallelism, len(items))
+        if workers <= 1:
+            return [call(item) for item in items]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(call, items))
 
     def login(self):
+        return self.sessions.renew()
+
+    def requestSession(self):
         # Build login command
         command = '--login "' + self.username + ';' + self.password + '"'
         # Send command with noSession as True as we do not yet have a user session
         result = self.sendCommand(command, True)
-
-        # Fix up the session_id by pulling off trailing LF and spaces, then convert to string
-        self.session_id = result
         print("Login successful. SessionID is " +
-              self.session_id.replace("--sessionId ", "").replace('"', ""))
+              result.replace("--sessionId ", "").replace('"', ""))
+        return result
 
-    def getRunningEmulations(self):
+    def getRunningEmulations(self, refresh=False):
+        # Hand out copies so callers can't change the cached snapshot
+        emulations = self.cache.get("emulations", self.fetchRunningEmulations, refresh)
+        return [dict(emulation) for emulation in emulations]
+
+    def fetchRunningEmulations(self):
         # example command - get a list of running emulations
         command = '--getemulations'
         # Send command
         result = self.sendCommand(command)
         # now process the results
-        # result will be --emulations "num emulations;emul name;emulation running;emulation notes;default emulation;username;start time;update time..."
-        # separate --emulations from the result data
-        header, data = result.split(' ', 1)
-        # kill off double and single quote chars from front and back
-        data = data.strip('"\'')
-        parts = data.split(';')  # create an array of the ; separated items
-        running_emulation_count = int(parts[0])
-        emulations = []
-        for emulationNum in range(running_emulation_count):
-            emulations.append(
-                {"id": int(parts[(emulationNum*8+1)]), "name": parts[(emulationNum*8+2)]})
+        emulations = self.parseEmulations(result)
+        if self.store is not None:
+            self.store.save(self.appliance, "emulations", emulations)
         return emulations
 
     def getRunningEmulationbyEmulationID(self, emulationId):
@@ -132,277 +1368,339 @@ class IT:
             emulation = None
         return emulation
 
-    def getPorts(self):
+    def getPorts(self, refresh=False):
+        # Hand out copies so callers can't change the cached snapshot
+        ports = self.getPortTable(refresh)
+        if ports is not None:
+            return [dict(port) for port in ports]
+
+    def getPortTable(self, refresh=False):
+        return self.cache.get("ports", self.fetchPorts, refresh)
+
+    def fetchPorts(self):
         command = '--getAllPorts'
-        result = self.sendCommand(command, False, True)
+        result = self.sendCommand(command)
         if result is not None:
-            header, data = result.split(' ', 1)
-            # kill off double and single quote chars from front and back
-            data = data.strip('"\'')
-            parts = data.split(';')  # create an array of the ; separated items
-            portCount = int(parts[0])
-            # Drop the first entry as it's just a count
-            parts.pop(0)
-            ports = []
-            for PortNum in range(portCount):
-                ports.append(
-                    {"id": int(parts[(PortNum*6+0)]),
-                     "name": parts[(PortNum*6+1)],
-                     "parent": int(parts[(PortNum*6+2)]) if parts[(PortNum*6+2)] != "-1" else None,
-                     "type": parts[(PortNum*6+4)],
-                     "subtype": parts[(PortNum*6+5)] if parts[(PortNum*6+5)] != "" else None
-                     })
-            return ports
+            ports = self.parsePorts(result)
+            if self.store is not None:
+                self.store.save(self.appliance, "ports", ports)
+            return PortTable(ports)
+
+    def findPorts(self, match=None):
+        # Yields the ports match accepts as they're parsed from a fresh --getAllPorts, without
+        # building the whole list or touching the cached table, e.g.
+        # findPorts(lambda port: port["name"] == address)
+        result = self.sendCommand('--getAllPorts')
+        if result is None or result.startswith("--error"):
+            return
+        for port in self.streamPorts(result):
+            if match is None or match(port):
+                yield port
+
+    def findEmulations(self, match=None):
+        # The same for a fresh --getemulations
+        result = self.sendCommand('--getemulations')
+        if result is None or result.startswith("--error"):
+            return
+        for emulation in self.streamEmulations(result):
+            if match is None or match(emulation):
+                yield emulation
 
     def getPort(self, portId, parent=False):
-        ports = self.getPorts()
-        try:
-            port = [d for d in ports if d['id'] == int(portId)][0]
-        except IndexError:
+        ports = self.getPortTable()
+        port = ports.get(portId)
+        if port is None:
             # TODO: Throw Exception
-            port = None
-        if parent and port is not None:
-            try:
-                parent = [d for d in ports if d['id']
-                          == int(port["parent"])][0]
-                port["parent"] = parent
-            except IndexError:
-                port["parent"] = None
+            return None
+        port = dict(port)
+        if parent:
+            parent = ports.getParent(port["id"])
+            port["parent"] = dict(parent) if parent is not None else None
         return port
 
-    def deletePort(self, portId):
+    def deletePort(self, portId, cached=True):
+        # cached=False leaves the cached port table alone, for callers deleting many ports that
+        # invalidate it once they're done rather than updating it after every one
         command = '--delPortModule ' + str(portId)
-        result = self.sendCommand(command, False, False)
+        # A port can briefly stay in use after its emulation has stopped
+        result = self.retry.run(lambda: self.sendCommand(command))
         if result == "--ok":
+            if cached:
+                self.portDeleted(portId)
             return True
-        # Delete the below code when iTrinegy patches this issue
-        bad_port_result = '--error "Port id [' + str(portId) + '] is in use in an emulation and so cannot be deleted"'
-        tries = 0
-        while not result != bad_port_result or tries == 3:
-            print(
-                "I'm told it's in use, backing off for a couple of seconds to make sure")
-            time.sleep(2)
-            print("Trying again...")
-            result = self.sendCommand(command, False, False)
-            print(result)
-            if result == "--ok":
-                return True
-            tries += 1
-        # End of code deletion block
         if result == '--error "Port id [' + str(portId) + '] has a child port and so cannot be deleted':
             return False
         else:
             print(result)
             return False
 
+    def portDeleted(self, portId):
+        self.cache.update("ports", lambda ports: ports.without(portId))
+
     def deletePortByAddress(self, address):
-        ports = self.getPorts()
+        ports = self.getPortTable()
         address = str(ipaddress.ip_address(address)-1)
-        try:
-            port = [d for d in ports if d['name'] == address][0]
-            print("I've found the port")
-        except IndexError:
+        port = ports.getByName(address)
+        if port is None:
             print("I've not found the port")
             return None
-        if port is not None:
-            try:
-                parent = [d for d in ports if d['id']
-                          == int(port["parent"])][0]
-                port["parent"] = parent
-                print("Deleting port", port["id"])
-                stop1 = self.deletePort(port["id"])
-                print("and the parent", port["parent"]["id"])
-                stop2 = self.deletePort(port["parent"]["id"])
-            except IndexError:
-                return False
+        print("I've found the port")
+        parent = ports.getParent(port["id"])
+        if parent is None:
+            return False
+        print("Deleting port", port["id"])
+        stop1 = self.deletePort(port["id"])
+        print("and the parent", parent["id"])
+        stop2 = self.deletePort(parent["id"])
         return True
 
     def createPort(self, wan_number, vlan, address, mask='255.255.255.252', gateway=None):
-        interface = None
-        if 1 <= wan_number <= 2:
-            if wan_number == 1:
-                interface = 0
-            elif wan_number == 2:
-                interface = 1
-        else:
+        interface = self.wanInterface(wan_number)
+        if interface is None:
             return False
-        ports = self.getPorts()
+        ports = self.getPortTable()
         # Check if the port exists first
-        try:
-            port = [d for d in ports if d['name'] == address][0]
-            parent = [d for d in ports if d['id'] == int(port["parent"])][0]
-            port["parent"] = parent
-        except IndexError:
-            port = None
+        port = ports.getByName(address)
+        parent = ports.getParent(port["id"]) if port is not None else None
 
-        if port:
+        if port is not None and parent is not None:
             print("Port found")
-            if port["parent"]["name"] != interface + "." + vlan:
+            if parent["name"] != str(interface) + "." + str(vlan):
                 print("Existing port VLAN is not the same, deleting...")
                 self.deletePort(port["id"])
-                self.deletePort(port["parent"]["id"])
+                self.deletePort(parent["id"])
             else:
                 print("Port already appears to be correct")
                 return False
         else:
             print("Port does not exist, creating it")
 
-        command = '--portModule "Default:Hardware_VLAN_Routing;' + str(interface) + ';VLAN_Interfaces[0].Interface_Name;' + str(interface) + '.' + str(
-            vlan) + ';VLAN_Interfaces[0].Use_As_Default_Interface;False;VLAN_Interfaces[0].VLAN_Id;' + str(vlan) + ';VLAN_Interfaces[0].Detag_Packets_on_Output;False"'
-        result = self.sendCommand(command, False, False)
+        vlan_command, ipv4_command = self.portCommands(
+            interface, vlan, address, mask, gateway)
+        result = self.sendCommand(vlan_command)
         print(result)
-        command = '--portModule "Default:Hardware_IPv4_Routing;' + str(interface) + '.' + str(vlan) + ';IPv4_Interfaces[0].Netmask;' + str(mask) + ';IPv4_Interfaces[0].Interface_Name;' + str(address) + ';IPv4_Interfaces[0].Gateway;' + (
-            str(gateway) if gateway is not None else '') + ';IPv4_Interfaces[0].Accept_Multicast_Traffic;No;IPv4_Interfaces[0].Address;' + str(address) + ';IPv4_Interfaces[0].Use_DHCP_Relay;No"'
-        result = self.sendCommand(command, False, True)
+        result = self.sendCommand(ipv4_command)
         print(result)
+        # We don't know the ids of the new ports, so fetch them next time they're asked for
+        self.cache.invalidate("ports")
         return True
 
-    def getAllVis(self):
-        emulations = self.getRunningEmulations()
-        if emulations is not None:
-            viList = []
-            for emulation in emulations:
-                viList.append(self.getVisByEmulationId(emulation["id"]))
-            return viList
+    def reconcilePorts(self, desired, prune=False, dry_run=False, parallelism=None):
+        # Bring the WAN ports in line with desired from a single --getAllPorts snapshot, see
+        # planPorts. Each phase runs its steps concurrently, a phase only starts once the one
+        # before it has finished so parents are always created before and deleted after children
+        plan = self.planPorts(self.getPortTable(refresh=True), desired, prune)
+        for line in self.describePlan(plan):
+            print(line)
+        if dry_run:
+            return {"plan": plan, "applied": 0, "failed": []}
+
+        def delete(step):
+            return self.deletePort(step["id"], cached=False)
+
+        def createVlan(step):
+            command = self.portCommands(step["interface"], step["vlan"], "", "", None)[0]
+            return self.sendCommand(command) == "--ok"
+
+        def createIpv4(step):
+            if (step["interface"], step["vlan"]) in failed_vlans:
+                return False
+            command = self.portCommands(step["interface"], step["vlan"], step["name"], step["mask"], step["gateway"])[1]
+            return self.sendCommand(command) == "--ok"
+
+        failed = []
+        failed_vlans = set()
+        applied = 0
+        try:
+            for phase, func in (("delete_ipv4", delete), ("delete_vlan", delete),
+                                ("create_vlan", createVlan), ("create_ipv4", createIpv4)):
+                for step, ok in zip(plan[phase], self.fanOut(func, plan[phase], parallelism)):
+                    if ok is True:
+                        applied += 1
+                        continue
+                    failed.append(dict(step, phase=phase))
+                    if phase == "create_vlan":
+                        failed_vlans.add((step["interface"], step["vlan"]))
+        finally:
+            # New ports' ids aren't known until the ports are listed again
+            self.cache.invalidate("ports")
+        return {"plan": plan, "applied": applied, "failed": failed}
+
+    def getAllVis(self, parallelism=None):
+        emulations = self.getRunningEmulations()
+        if emulations is not None:
+            versions = {emulation["id"]: emulation.get("updated") for emulation in emulations}
+            return self.fanOut(lambda emulationId: self.getVisByEmulationId(emulationId, parallelism, versions[emulationId]),
+                               [emulation["id"] for emulation in emulations], parallelism)
+        else:
+            return None
+
+    def getVisByEmulationId(self, emulationId, parallelism=None, version=None):
+        # With a store, VI settings saved at the emulation's current update time are used as they are
+        if self.store is not None:
+            if version is None:
+                emulation = self.getRunningEmulationbyEmulationID(emulationId)
+                version = emulation.get("updated") if emulation is not None else None
+            if version:
+                stored = self.store.load(self.appliance, "vis:" + str(emulationId))
+                if stored is not None and stored[0] == version:
+                    return [self.restoreVi(vi) for vi in stored[1]]
+        vis = self.fetchVisByEmulationId(emulationId, parallelism)
+        if self.store is not None and version and vis is not None and \
+                all(vi is not None and "error" not in vi for vi in vis):
+            self.store.save(self.appliance, "vis:" + str(emulationId), vis, version)
+        return vis
+
+    def fetchVisByEmulationId(self, emulationId, parallelism=None):
+        vi_Ids = self.getViIdsByEmulationId(emulationId)
+        if vi_Ids is not None:
+            return self.fanOut(self.getViByViId, vi_Ids, parallelism)
         else:
             return None
 
-    def getVisByEmulationId(self, emulationId):
+    def restoreVi(self, vi):
+        # VI settings read back from JSON get their procModule lookups back
+        if "procModule" in vi:
+            vi["procModule"] = ProcModules(vi["procModule"])
+        return vi
+
+    def viChanged(self, vi_id):
+        # The emulation's update time moves when one of its VIs changes, relist to see the new
+        # one before trusting any stored VI settings again
+        if self.store is not None:
+            self.cache.invalidate("emulations")
+
+    def warmStart(self, background=True):
+        # Serve listings from the store straight away, then refetch everything from the INE,
+        # saving what changed, by default on a background thread
+        if self.store is None:
+            return None
+        stored = self.store.load(self.appliance, "emulations")
+        if stored is not None:
+            self.cache.put("emulations", stored[1])
+        stored = self.store.load(self.appliance, "ports")
+        if stored is not None:
+            self.cache.put("ports", PortTable(stored[1]))
+
+        def revalidate():
+            try:
+                self.getPortTable(refresh=True)
+                emulations = self.getRunningEmulations(refresh=True)
+                # Only emulations that changed since their VIs were stored get fetched again
+                for emulation in emulations or []:
+                    self.getVisByEmulationId(emulation["id"], version=emulation.get("updated"))
+            except Exception as ex:
+                print("Unable to revalidate the stored snapshot:", ex)
+
+        if not background:
+            revalidate()
+            return None
+        thread = threading.Thread(target=revalidate, name="itrinegy-revalidate", daemon=True)
+        thread.start()
+        return thread
+
+    def getViIdsByEmulationId(self, emulationId):
         command = '--emulationId ' + str(emulationId) + ' --getVIsForEmulation'
         result = self.sendCommand(command)
-        if result is not None:
-            # separate --VIsForEmulation from the result data
-            header, data = result.split(' ', 1)
-            # kill off double and single quote chars from front and back
-            data = data.strip('"\'')
-            # create an array of the ; separated items
-            vi_Ids = data.split(';')
-            # Remove the last one as it's just a blank line
-            vi_Ids.pop(len(vi_Ids)-1)
-            # Remove the first as that is also just rubbish
-            vi_Ids.pop(0)
-            # Create a list to fill in the next step
-            viList = []
-            for vi in vi_Ids:
-                viList.append(self.getViByViId(vi))
-
-            return viList
-        else:
-            return None
+        if result is not None and not result.startswith("--error"):
+            return self.parseViIds(result)
+        return None
 
     def getViIdsByEmulationIdAndViName(self, emulationId, names=['Internet', 'MPLS'], impairments=False):
         vis = self.getVisByEmulationId(emulationId)
-        namedVis = [d for d in vis if d['name'] in names]
+        if vis is None:
+            return []
+        namedVis = [d for d in vis if d is not None and d.get('name') in names]
         if impairments:
-            for i, vi in enumerate(namedVis):
-                namedVis[i]["impairments"] = self.getImpairmentsByViId(
-                    vi["id"])
+            # We already have the settings for each VI, so there's no need to fetch them again
+            for vi in namedVis:
+                vi["impairments"] = self.impairmentsFromVi(vi)
         return namedVis
 
     def getViByViId(self, vi_id):
         command = '--Id ' + str(vi_id) + ' --getVISettings'
         # Send the command
-        result = self.sendCommand(command, False, True)
-        # Split the results into a list
-        result = shlex.split(result)
-        # Get all posible arguments in the list and compile it into a dictionary
-        try:
-            optlist = getopt.getopt(result, '', ['id=', 'name=', 'setUserGivenId=', 'vitype=', 'groupname=', 'xpos=',
-                                                 'ypos=', 'width=', 'height=', 'objdir=', 'image=', 'notes=', 'meta=', 'procModule='])[0]
-            full_list = defaultdict(list)
-            for k, v in optlist:
-                if k == "--procModule":
-                    full_list[self.removeDashes(str(k))].append(v)
-                else:
-                    full_list.update({
-                        self.removeDashes(str(k)): v
-                    })
-        except getopt.GetoptError:
-            full_list = None
-        return full_list
+        result = self.sendCommand(command)
+        return self.parseViSettings(result)
 
     def getImpairmentsByViId(self, vi_id):
-        try:
-            latency = self.getLatencyByViId(vi_id)["latency"]
-            loss = self.getLossByViId(vi_id)["loss"]
-            errors = self.getErrorsByViId(vi_id)["errors"]
-            impairments = {
-                "latency": latency,
-                "loss": loss,
-                "errors": errors
-            }
-        except TypeError:
+        vi = self.getViByViId(vi_id)
+        if vi is not None:
+            return self.impairmentsFromVi(vi)
+        else:
             return None
 
-        return impairments
-
     def getLatencyByViId(self, vi_id):
         vi = self.getViByViId(vi_id)
         if vi is not None:
-            sub = 'Default:Random_Delay;50;Min_Delay;'
-            latency = next((s for s in vi['procModule'] if sub in s), None)
-            if not latency:
-                return {"latency": 0}
-            else:
-                return {"latency": int(float(latency.replace(sub, '').replace(';Max_Delay;', ':').split(':')[0]))*2}
+            return self.latencyFromVi(vi)
         else:
             return None
 
     def getLossByViId(self, vi_id):
         vi = self.getViByViId(vi_id)
         if vi is not None:
-            sub = 'Default:Random_Drop;30;Loss_Percent;'
-            loss = next((s for s in vi['procModule'] if sub in s), None)
-            if not loss:
-                return {"loss": 0}
-            else:
-                return {"loss": int(float(loss.replace(sub, '').replace(';', '')))*2}
+            return self.lossFromVi(vi)
         else:
             return None
 
     def getErrorsByViId(self, vi_id):
         vi = self.getViByViId(vi_id)
         if vi is not None:
-            sub = 'Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;'
-            errors = next((s for s in vi['procModule'] if sub in s), None)
-            if not errors:
-                return {"errors": 0}
-            else:
-                return {"errors": int(float(errors.replace(sub, '').replace(';', '')))*2}
+            return self.errorsFromVi(vi)
         else:
             return None
 
     def resetAllImpairmentsByViId(self, vi_id):
-        impairments = []
-        impairments.append(self.applyLatency(vi_id, 0))
-        impairments.append(self.applyLoss(vi_id, 0))
-        impairments.append(self.applyErrors(vi_id, 0))
-        return impairments
+        applied = self.applyImpairments(vi_id, 0, 0, 0)
+        if applied is None:
+            return [None, None, None]
+        return [{'latency': applied['latency']}, {'loss': applied['loss']}, {'errors': applied['errors']}]
+
+    def applyImpairments(self, vi_id, latency=None, loss=None, errors=None):
+        # Apply any mix of latency, loss and errors to a VI in one command
+        command, applied = self.impairmentsCommand(vi_id, latency, loss, errors)
+        if not applied:
+            return {}
+        result = self.sendCommand(command)
+        if result == "--ok":
+            self.viChanged(vi_id)
+            return applied
+
+    def applyImpairmentsBulk(self, changes, parallelism=None):
+        # changes maps VI ids to a dict of latency, loss and/or errors. Each VI gets one combined
+        # command and the VIs are sent concurrently. Returns what was applied to each VI (None if
+        # the INE refused it, {"id", "error"} if it failed outright) and the total wall time
+        started = time.monotonic()
+        vi_ids = list(changes)
+        results = self.fanOut(lambda vi_id: self.applyImpairments(
+            vi_id, **changes[vi_id]), vi_ids, parallelism)
+        return {"results": dict(zip(vi_ids, results)),
+                "elapsed": time.monotonic() - started}
 
     def applyLatency(self, vi_id, latency_value):
         latency_value = latency_value/2
-        command = '--Id ' + str(vi_id) + ' --procModule "Default:Random_Delay;50;Min_Delay;' + \
-            str(latency_value) + ';Max_Delay;' + \
-            str(latency_value+0.1) + ';"'
+        command = self.latencyCommand(vi_id, latency_value)
         print(command)
         result = self.sendCommand(command)
         if result == "--ok":
+            self.viChanged(vi_id)
             return {'latency': latency_value*2}
 
     def applyLoss(self, vi_id, loss_percent):
         loss_percent = loss_percent/2
-        command = '--Id ' + str(vi_id) + ' --procModule "Default:Random_Drop;30;Loss_Percent;' + \
-            str(loss_percent) + ';"'
+        command = self.lossCommand(vi_id, loss_percent)
         result = self.sendCommand(command)
         if result == "--ok":
+            self.viChanged(vi_id)
             return {'loss': loss_percent*2}
 
     def applyErrors(self, vi_id, error_percent):
         error_percent = error_percent/2
-        command = '--Id ' + str(vi_id) + ' --procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;' + \
-            str(error_percent) + ';"'
+        command = self.errorsCommand(vi_id, error_percent)
         result = self.sendCommand(command)
         if result == "--ok":
+            self.viChanged(vi_id)
             return {'errors': error_percent*2}
 
     def stopRunningEmulation(self, emulationId):
@@ -412,11 +1710,74 @@ class IT:
             command = '--emulationId ' + str(emulationId) + ' --stop'
             result = self.sendCommand(command)
             if result == "--ok":
+                self.cache.update("emulations", lambda emulations: [
+                                  d for d in emulations if d['id'] != int(emulationId)])
                 return "Emulation stopped"
         else:
             return None
 
-    def createEmulation(self, product, devices, overwrite=None):
+    def teardown(self, emulation_ids=(), addresses=(), parallelism=None):
+        # Stop a set of emulations and delete a set of ports, given by their addresses as named
+        # on the INE, working from one listing of each. The emulations are stopped together, then
+        # the ports deleted together, then the VLANs they were on, as long as nothing else is still
+        # on the VLAN. Returns the outcome for every emulation and port and the time it all took
+        started = time.monotonic()
+        outcome = {"emulations": {}, "ports": {}}
+        running = {emulation["id"] for emulation in self.getRunningEmulations(refresh=True)} if emulation_ids else set()
+        ports = self.getPortTable(refresh=True) if addresses else PortTable([])
+
+        stopping = []
+        for emulationId in emulation_ids:
+            if int(emulationId) in running:
+                stopping.append(int(emulationId))
+            else:
+                outcome["emulations"][emulationId] = "not found"
+
+        def stop(emulationId):
+            return self.sendCommand('--emulationId ' + str(emulationId) + ' --stop') == "--ok"
+
+        for emulationId, ok in zip(stopping, self.fanOut(stop, stopping, parallelism)):
+            outcome["emulations"][emulationId] = "stopped" if ok is True else "failed"
+        stopped = {emulationId for emulationId in stopping if outcome["emulations"][emulationId] == "stopped"}
+        if stopped:
+            self.cache.update("emulations", lambda emulations: [d for d in emulations if d['id'] not in stopped])
+
+        deleting = []
+        for address in addresses:
+            port = ports.getByName(address)
+            if port is None:
+                outcome["ports"][address] = {"deleted": False, "error": "not found"}
+            else:
+                deleting.append((address, port))
+        # The ports go first as a VLAN can't be deleted while it still has a port on it. Ports that
+        # were in a stopped emulation can take a moment to be released, deletePort retries them
+        for (address, port), ok in zip(deleting, self.fanOut(lambda entry: self.deletePort(entry[1]["id"], cached=False),
+                                                             deleting, parallelism)):
+            outcome["ports"][address] = {"deleted": ok is True}
+        gone = {port["id"] for address, port in deleting if outcome["ports"][address]["deleted"]}
+
+        vlans = {}
+        for address, port in deleting:
+            parent = ports.getParent(port["id"])
+            if parent is not None and parent["parent"] is not None:
+                outcome["ports"][address]["vlan"] = parent["name"]
+                vlans.setdefault(parent["id"], (parent, []))[1].append(address)
+        emptied = [(parent, owners) for parent, owners in vlans.values()
+                   if all(child["id"] in gone for child in ports.getChildren(parent["id"]))]
+        for (parent, owners), ok in zip(emptied, self.fanOut(lambda entry: self.deletePort(entry[0]["id"], cached=False),
+                                                             emptied, parallelism)):
+            for address in owners:
+                outcome["ports"][address]["vlan_deleted"] = ok is True
+        for parent, owners in vlans.values():
+            for address in owners:
+                # None when the VLAN was left alone as something is still on it
+                outcome["ports"][address].setdefault("vlan_deleted", None)
+        if deleting:
+            self.cache.invalidate("ports")
+        outcome["elapsed"] = time.monotonic() - started
+        return outcome
+
+    def createEmulation(self, product, devices, overwrite=None, parallelism=None, summarize_routes=False):
         emulations = self.getRunningEmulations()
         for emulation in emulations:
             if emulation["name"] == product.name:
@@ -426,281 +1787,858 @@ class IT:
                     return {"message": "Emulation already running",
                             "emulation": emulation}, 400
 
+        timings = {}
+        stage_start = time.monotonic()
         command = '--addEmulation "' + product.name + '"'
         emulationId = self.sendCommand(command)
-
-        # Instantiate the FW
-        FW_Vi = {"name": "Firewall",
-                 "xpos": ((self.emulation_settings["width"]/2)-self.emulation_settings["object_wh"]/2),
-                 "ypos": self.emulation_settings["height"]-280,
-                 # Add the product gateway IP
-                 "address": ipaddress.ip_address(product.gateway_ip)+1,
-                 "mask": "255.255.255.252",
-                 "gateway": ipaddress.ip_address(product.gateway_ip),
-                 "vlan": product.vlan.vlan,
-                 "number": 1}  # Set a FW port to 1
-
-        # Instantiate the Outer VI
-        Outer_Vi = {"name": "Outer",
-                    "xpos": FW_Vi["xpos"],
-                    "ypos": FW_Vi["ypos"]-100,
-                    "routes": []}
-
-        # Instantiate the Internet VI
-        Internet_Vi = {"name": "Internet",
-                       "xpos": Outer_Vi["xpos"]-self.emulation_settings["gw_distance"],
-                       "ypos": Outer_Vi["ypos"]-150,
-                       "routes": []}
-
-        # Instantiate the MPLS VI
-        MPLS_Vi = {"name": "MPLS",
-                   "xpos": Outer_Vi["xpos"]+self.emulation_settings["gw_distance"],
-                   "ypos": Outer_Vi["ypos"]-150,
-                   "routes": []}
-
-        # Define the link to add at the end
-        FW_Vi["parent"] = Outer_Vi["name"] + " Link: " + \
-            FW_Vi["name"] + " --> " + Outer_Vi["name"]
-
-        # Instantiate the links
-        vis = []
-        vis.extend(self.createLinkVi(emulationId, MPLS_Vi, Outer_Vi))
-        vis.extend(self.createLinkVi(emulationId, Internet_Vi, Outer_Vi))
-        vis.extend(self.createLinkVi(emulationId, Outer_Vi, FW_Vi))
-
-        ### Build the devices ###
-        wan1_positions = {"xpos": Internet_Vi["xpos"] - 210,
-                          "ypos": 220}
-        wan2_positions = {"xpos": MPLS_Vi["xpos"] + 210,
-                          "ypos": 220}
-        device_vis = []
-        for device in devices:
-            if device.wan1 is not None:
-                Device_Vi = {}  # Create the dict before we can use it
-                Device_Vi["number"] = 1
-                Device_Vi["gateway"] = str(
-                    ipaddress.ip_address(device.wan1.address.address))
-                Device_Vi["address"] = str(
-                    ipaddress.ip_address(device.wan1.address.address)-1)
-                Device_Vi["mask"] = str(ipaddress.ip_network(
-                    device.wan1.address.address + "/" + str(device.wan1.address.mask), strict=False).netmask)
-                Device_Vi["vlan"] = device.wan1.vlan.vlan
-                Device_Vi["name"] = device.name + '-GW0'
-                Device_Vi["type"] = "device"
-
-                Device_Vi["xpos"] = wan1_positions["xpos"]
-                Device_Vi["ypos"] = wan1_positions["ypos"]
-                Device_Vi["parent"] = "Internet"
-                Internet_Vi["routes"].append(
-                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Device_Vi["name"]})
-                Outer_Vi["routes"].append(
-                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Internet_Vi["name"] + ' Link: ' + Outer_Vi["name"] + " --> " + Internet_Vi["name"]})
-                # Move the next object down
-                wan1_positions["ypos"] += self.emulation_settings["object_wh"] + \
-                    self.emulation_settings["object_wh"]/4
-                device_vis.append(Device_Vi)
-
-            if device.wan2 is not None:
-                Device_Vi = {}  # Create the dict before we can use it
-                Device_Vi["number"] = 2
-                Device_Vi["gateway"] = str(
-                    ipaddress.ip_address(device.wan2.address.address))
-                Device_Vi["address"] = str(
-                    ipaddress.ip_address(device.wan2.address.address)-1)
-                Device_Vi["mask"] = str(ipaddress.ip_network(
-                    device.wan2.address.address + "/" + str(device.wan2.address.mask), strict=False).netmask)
-                Device_Vi["vlan"] = device.wan2.vlan.vlan
-                Device_Vi["name"] = device.name + '-GW1'
-                Device_Vi["type"] = "device"
-
-                Device_Vi["xpos"] = wan2_positions["xpos"]
-                Device_Vi["ypos"] = wan2_positions["ypos"]
-                Device_Vi["parent"] = "MPLS"
-                MPLS_Vi["routes"].append(
-                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": Device_Vi["name"]})
-                Outer_Vi["routes"].append(
-                    {"ip": Device_Vi["address"], "mask": Device_Vi["mask"], "portOut": MPLS_Vi["name"] + ' Link: ' + Outer_Vi["name"] + " --> " + MPLS_Vi["name"]})
-                # Move the next object down
-                wan2_positions["ypos"] += self.emulation_settings["object_wh"] + \
-                    self.emulation_settings["object_wh"]/4
-                device_vis.append(Device_Vi)
-
-        Internet_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": Internet_Vi["name"] +
-                                      ' Link: ' + Internet_Vi["name"] + " --> " + Outer_Vi["name"]})
-        MPLS_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": MPLS_Vi["name"] +
-                                  ' Link: ' + MPLS_Vi["name"] + " --> " + Outer_Vi["name"]})
-        Outer_Vi["routes"].append({"ip": '0.0.0.0', "mask": '0.0.0.0', "portOut": Outer_Vi["name"] +
-                                   ' Link: ' + Outer_Vi["name"] + " --> " + FW_Vi["name"]})
-
-        for vi in device_vis:
-            vis.append(self.createObjectVi(emulationId, vi))
-        vis.append(self.createObjectVi(emulationId, MPLS_Vi))
-        vis.append(self.createObjectVi(emulationId, Internet_Vi))
-        vis.append(self.createObjectVi(emulationId, Outer_Vi))
-        vis.append(self.createObjectVi(emulationId, FW_Vi))
-
-        for vi in vis:
-            self.amendVi(emulationId, vi)
+        emulation = {"id": int(emulationId.replace("--emulationId ", "")),
+                     "name": product.name}
+
+        FW_Vi, Outer_Vi, Internet_Vi, MPLS_Vi, device_vis = self.planEmulation(
+            product, devices)
+        report = {"timings": timings}
+        if summarize_routes:
+            # Fewer, wider routes for the same forwarding, see summarizeRoutes
+            report["routes_removed"] = 0
+            for vi in (Outer_Vi, Internet_Vi, MPLS_Vi):
+                vi["routes"], removed = self.summarizeRoutes(vi["routes"])
+                report["routes_removed"] += removed
+            print("Route summarization removed", report["routes_removed"], "routes")
+        links = self.planLinks(MPLS_Vi, Outer_Vi) + \
+            self.planLinks(Internet_Vi, Outer_Vi) + \
+            self.planLinks(Outer_Vi, FW_Vi)
+        objects = [self.planObjectVi(vi) for vi in device_vis + [MPLS_Vi, Internet_Vi, Outer_Vi, FW_Vi]]
+        vis = links + objects
+        timings["setup"] = time.monotonic() - stage_start
+
+        # The build runs in stages, each one fanned out across up to parallelism commands at once.
+        # VIs only refer to each other by name, so all of them can be created together, then once
+        # every VI exists they can all be amended together
+        stage_start = time.monotonic()
+        vi_ids = self.fanOut(lambda vi: self.createVi(
+            emulationId, vi["name"]), vis, parallelism)
+        failed = []
+        for vi, vi_id in zip(vis, vi_ids):
+            if isinstance(vi_id, dict) or vi_id.startswith("--error"):
+                failed.append(vi["name"])
+            else:
+                vi["id"] = vi_id
+        timings["create"] = time.monotonic() - stage_start
+
+        if not failed:
+            stage_start = time.monotonic()
+            amended = self.fanOut(lambda vi: self.amendVi(
+                emulationId, vi), vis, parallelism)
+            failed = [vi["name"] for vi, ok in zip(vis, amended) if ok is not True]
+            timings["amend"] = time.monotonic() - stage_start
+
+        print("Emulation build timings:", timings)
+        if failed:
+            # Don't start an emulation that's only half built
+            self.cache.invalidate("emulations")
+            return dict({"message": "Emulation not started, unable to build every VI",
+                         "emulation": emulation,
+                         "failed": failed}, **report), 500
 
         # Finally, start the emulation
+        stage_start = time.monotonic()
         command = emulationId + ' --start'
         result = self.sendCommand(command)
+        timings["start"] = time.monotonic() - stage_start
         print("Result:", result)
-        return {"id": int(emulationId.replace("--emulationId ", "")),
-                "name": product.name}
+        if result == "--ok":
+            self.cache.update("emulations", lambda emulations: emulations + [emulation])
+        else:
+            self.cache.invalidate("emulations")
+        return dict(emulation, **report)
 
     def createObjectVi(self, emulationId, vi):
         vi["id"] = self.createVi(emulationId, vi["name"])
-        vi["width"] = vi["height"] = self.emulation_settings["object_wh"]
-        if not vi.get("objdir"):
-            vi["objdir"] = 0
-        return vi
+        return self.planObjectVi(vi)
 
     def amendVi(self, emulationId, vi):
-        command = '--id ' + vi["id"] + ' '
-        groupname = vi["name"]
-        vitype = "picture"
-        # Mandatory procs need applying
-        command += '--procModule "Default:Debug;10;Dump_Packet;0;Bytes_to_Dump;80;" ' + \
-                   '--procModule "Default:Generic_Filter;20;" ' + \
-                   '--procModule "Default:Random_Drop_with_Burst;30;Loss_Percent;0.0;Minimum_Packets_to_Drop;1;Maximum_Packets_to_Drop;1;" ' + \
-                   '--procModule "Default:Random_Packet_Corrupt;40;Packet_Corruption_Percent;0.0;" ' + \
-                   '--procModule "Default:Step_Delay_Packet_Nanoseconds;50;Min_Delay;0;Max_Delay;0;Step_Delay;0;" ' + \
-                   '--procModule "Default:Fragment_MTU;55;MTU_Limit;0;Dont_Fragment_Flag_Option;Fragment Anyway;" '
-        # Apply routing depending on which type of object it is
-        if vi.get("address"):
-            command += '--procModule "Default:Symmetric_Routing;60;'
-            if vi.get("parent"):
-                command += 'Routes[0].Port_Out;' + vi["parent"] + \
-                    ';Routes[0].Port_In;' + str(vi["address"]) + ';'
-            command += 'Port_In;' + \
-                str(vi["address"]) + ';Port_Out;' + str(vi["address"]) + ';" '
-            image = 'LAN/Port.png'
-        else:
-            image = 'Standard/Router.png'
-        if vi["objdir"] > 0:
-            command += '--procModule "Default:Generic_Routing;60;' + \
-                       'Port_In;Virtual;' + \
-                       'Port_Out;' + vi["parent"] + ';" '
-            image = 'Standard/FullDuplex.png'
-            groupname = vi["groupname"]
-            vitype = "lineobject"
-        if vi.get("routes"):
-            command += '--procModule "Default:IPv4_Routing;60;'
-            for routeNumber, route in enumerate(vi["routes"]):
-                net = ipaddress.ip_network(
-                    route["ip"] + '/' + route["mask"], strict=False)
-                command += 'Routes[' + str(routeNumber) + '].Route_Disabled;0;' + \
-                    'Routes[' + str(routeNumber) + '].Port_In;Virtual;' + \
-                    'Routes[' + str(routeNumber) + '].Port_Out;' + route["portOut"] + ';' + \
-                    'Routes[' + str(routeNumber) + '].Network_Mask;' + str(net.netmask) + ';' + \
-                    'Routes[' + str(routeNumber) + '].Network_Address;' + \
-                    str(net.network_address) + ';'
-            command += 'Port_In;;Port_Out;;" '
-
-        # Now for more mandatory procs
-        command += '--procModule "Default:Packet_Move_and_Duplicate;62;Selection_Percent;0.0;Duplicate_Packet;0;Minimum_Move;0;Maximum_Move;0;" ' + \
-                   '--procModule "Default:Random_Packet_Move_Offset;65;Move_Percent;0.0;Minimum_Move;1;Maximum_Move;1;" ' + \
-                   '--procModule "Default:Linkspeed_and_FIFO_Queue_Bytes;70;Link_Type;Manual;Link_Speed;0;Queue_Length;64000;Overhead;18;Congestion_PCT;0.0;TTL_Cost;0;" '
-        if vitype == "lineobject":
-            command += '--procModule "Default:;80;" '
-
-        command += '--vitype "' + vitype + '" '
-        command += '--groupname "' + groupname + '" '
-        command += '--xpos ' + str(vi["xpos"]) + ' --ypos ' + str(vi["ypos"]) + ' --width ' + str(vi["width"]) + ' --height ' + \
-            str(vi["height"]) + ' --objdir ' + str(vi["objdir"]) + ' '
-        command += '--image "' + image + '" '
-        command += '--notes "" '
-
-        result = self.sendCommand(command)
+        command = self.amendCommand(vi)
+        # The port a device VI needs can briefly still be held by the emulation it was last used in
+        result = self.retry.run(lambda: self.sendCommand(command))
         if vi.get("address"):
-            # Delete the below code when iTrinegy patches this issue
-            bad_port_result = '--error "[' + vi["name"] + ' - Default:Symmetric_Routing]: Object ' + vi["name"] + \
-                ': Cannot Open a connection to Input port (' + str(
-                    vi["address"]) + ') - likely it\'s already in use"'
-            tries = 0
-            while not result != bad_port_result or tries == 3:
-                print(
-                    "I'm told the port I need is in use, backing off for a couple of seconds")
-                time.sleep(1)
-                print("Trying again...")
-                result = self.sendCommand(command)
-                tries += 1
-            # End of code deletion block
-            if result == '--error "[' + vi["name"] + ' - Default:Symmetric_Routing]: Object ' + vi["name"] + ': No such port (' + str(vi["address"]) + ')"':
+            if result == self.noSuchPortError(vi):
                 print("Looks like the port doesn't exist...")
                 self.createPort(vi["number"], vi["vlan"],
                                 vi["address"], vi["mask"], vi["gateway"])
-                result = self.sendCommand(command)
+                result = self.retry.run(lambda: self.sendCommand(command))
             else:
                 print(result)
         else:
             print(result)
+        return result == "--ok"
 
     def createLinkVi(self, emulationId, from_vi, to_vi):
-        link_name = from_vi["name"] + " Link"
-        links = [
-            {"name": link_name + ': ' +
-                from_vi["name"] + ' --> ' + to_vi["name"], "parent": to_vi["name"]},
-            {"name": link_name + ': ' +
-                to_vi["name"] + ' --> ' + from_vi["name"], "parent": from_vi["name"]}
-        ]
-
-        xpos = int(from_vi["xpos"]) + (self.emulation_settings["object_wh"]/2)
-        ypos = int(from_vi["ypos"]) + (self.emulation_settings["object_wh"]/2)
-        width = int(to_vi["xpos"]) - int(from_vi["xpos"])
-        height = int(to_vi["ypos"]) - int(from_vi["ypos"])
-        objdir = 1
-        if width < 0:
-            width = abs(width)
-            xpos = int(to_vi["xpos"]) + \
-                (self.emulation_settings["object_wh"]/2)
-            objdir += 1
-        elif width == 0:
-            width = 2
-            xpos -= 5
-            objdir = 2
-        if height < 0:
-            height = abs(height)
-            ypos = int(to_vi["ypos"]) + \
-                (self.emulation_settings["object_wh"]/2)
-            objdir += 2
-        elif height == 0:
-            height = 2
-            ypos -= 5
-        vis = []
-        for link in links:
-            vis.append({"name": link["name"], "parent": link["parent"], "id": self.createVi(emulationId, link["name"]), "xpos": int(xpos), "ypos": int(
-                ypos), "width": int(width), "height": int(height), "objdir": objdir, "groupname": link_name})
+        vis = self.planLinks(from_vi, to_vi)
+        for vi in vis:
+            vi["id"] = self.createVi(emulationId, vi["name"])
         return vis
 
     def createVi(self, emulationId, name):
         return self.sendCommand(emulationId + ' ' + '--addVi "' + str(name) + '"').replace("--id ", "")
 
-    def removeDashes(self, variable):
-        variable = variable.replace("--", "")
-        return variable
 
+class ITWatcher:
+    # Polls an IT client for running emulations, ports and VIs, keeping the last snapshot of each
+    # and handing subscribers only what was added, removed or changed since the previous poll.
+    # Events are dicts of kind ("emulation", "port" or "vi"), change ("added", "removed" or
+    # "changed"), id, record and previous, and the appliance when watching an ITCluster. Every
+    # emulation's VI list is checked each poll, but settings are only fetched for new VIs and for
+    # the VIs of emulations whose update time moved, so a quiet INE costs a --getemulations, a
+    # --getAllPorts and a --getVIsForEmulation per emulation
+    def __init__(self, client, interval=5.0, ports=True, vis=True):
+        self.client = client
+        self.interval = interval
+        self.watch_ports = ports
+        self.watch_vis = vis
+        self.emulations = {}
+        self.ports = {}
+        self.vis = {}
+        # VIs whose settings couldn't be fetched, they're tried again next poll
+        self.unfetched = set()
+        self.subscribers = []
+        self.stats = {"polls": 0, "events": 0, "vi_fetches": 0}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def key(self, item_id, appliance=None):
+        # Ids are only unique per appliance, so an ITCluster's records are keyed by both
+        return (appliance, int(item_id)) if appliance is not None else int(item_id)
+
+    def event(self, kind, change, key, record, previous):
+        event = {"kind": kind, "change": change, "id": key, "record": record, "previous": previous}
+        if isinstance(key, tuple):
+            event["appliance"], event["id"] = key
+        return event
+
+    def diff(self, kind, previous, current):
+        events = []
+        for key, record in current.items():
+            if key not in previous:
+                events.append(self.event(kind, "added", key, record, None))
+            elif previous[key] != record:
+                events.append(self.event(kind, "changed", key, record, previous[key]))
+        for key, record in previous.items():
+            if key not in current:
+                events.append(self.event(kind, "removed", key, None, record))
+        return events
+
+    def poll(self):
+        # One round of fetching and diffing, returns the events after handing them to subscribers
+        events = []
+        emulations = self.client.getRunningEmulations(refresh=True)
+        if emulations is not None:
+            current = {self.key(emulation["id"], emulation.get("appliance")): emulation for emulation in emulations}
+            if self.watch_vis:
+                events += self.pollVis(current)
+            events = self.diff("emulation", self.emulations, current) + events
+            self.emulations = current
+        if self.watch_ports:
+            ports = self.client.getPorts(refresh=True)
+            if ports is not None:
+                current = {self.key(port["id"], port.get("appliance")): port for port in ports}
+                events += self.diff("port", self.ports, current)
+                self.ports = current
+        self.stats["polls"] += 1
+        self.stats["events"] += len(events)
+        for event in events:
+            for callback in list(self.subscribers):
+                try:
+                    callback(event)
+                except Exception as ex:
+                    print("Watcher subscriber failed:", ex)
+        return events
+
+    def pollVis(self, emulations):
+        # self.vis maps emulation keys to the VIs last seen in them, keyed the same way by VI id
+        events = []
+        for key in list(self.vis):
+            if key not in emulations:
+                self.unfetched.difference_update(self.vis[key])
+                events += self.diff("vi", self.vis.pop(key), {})
+        for key, emulation in emulations.items():
+            appliance = emulation.get("appliance")
+            # An ITCluster is told which appliance is meant, ids can be on more than one
+            where = {"appliance": appliance} if appliance is not None else {}
+            vi_ids = self.client.getViIdsByEmulationId(emulation["id"], **where)
+            if vi_ids is None:
+                continue
+            vi_ids = [int(vi_id) for vi_id in vi_ids]
+            previous = self.vis.get(key, {})
+            last = self.emulations.get(key)
+            # No update time means there's no telling whether it changed, so refetch everything
+            if last is not None and key in self.vis and emulation.get("updated") and \
+                    last.get("updated") == emulation.get("updated"):
+                # The VIs already seen haven't changed, only the list can have, so only new VIs need fetching
+                # and any whose fetch failed last time
+                wanted = [vi_id for vi_id in vi_ids if self.key(vi_id, appliance) not in previous or
+                          self.key(vi_id, appliance) in self.unfetched]
+            else:
+                wanted = vi_ids
+            vis = self.client.fanOut(lambda vi_id: self.client.getViByViId(vi_id, **where), wanted)
+            fetched = {self.key(vi_id, appliance): vi for vi_id, vi in zip(wanted, vis)}
+            self.stats["vi_fetches"] += len(wanted)
+            current = {}
+            for vi_id in vi_ids:
+                vi_key = self.key(vi_id, appliance)
+                vi = fetched.get(vi_key)
+                if vi is not None and "error" not in vi:
+                    self.unfetched.discard(vi_key)
+                else:
+                    if vi_key in fetched:
+                        # The fetch failed, the VI is still in the list so it stays as it was last
+                        # seen until it's fetched again next poll
+                        self.unfetched.add(vi_key)
+                    vi = previous.get(vi_key)
+                if vi is not None:
+                    current[vi_key] = vi
+            events += self.diff("vi", previous, current)
+            self.unfetched.difference_update(set(previous) - set(current))
+            self.vis[key] = current
+        return events
+
+    def start(self):
+        # Poll every interval seconds on a background thread until stopped
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="itrinegy-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception as ex:
+                print("Watcher poll failed:", ex)
+            # Polls keep to a fixed schedule, but one that overran doesn't cause a burst of catch up polls
+            next_poll = max(next_poll + self.interval, time.monotonic())
+            if self._stopped.wait(max(0.0, next_poll - time.monotonic())):
+                return
+
+
+class ITCluster:
+    # Spreads emulations across several INEs. Takes the IT clients for each appliance and offers
+    # the same emulation, VI and impairment methods as IT so it can be handed to set_client.
+    # New emulations go to the least loaded appliance, by running emulations or by ports in use
+    # (placement="ports"), listings query every appliance at once and are tagged with the
+    # appliance each entry came from, and anything addressed by an emulation, VI or port id is
+    # sent to the appliance that owns it. Ids are only unique per appliance, so an id found on
+    # more than one needs appliance= passing to say which is meant. Ports given by address go to
+    # the appliance the address is on, new ones to where a new emulation would be placed
+    def __init__(self, clients, placement="emulations", parallelism=None):
+        self.appliances = {}
+        for client in clients:
+            self.appliances[client.ipstr + ":" + str(client.port)] = client
+        self.placement = placement
+        self.parallelism = parallelism or len(self.appliances)
+        self.owners = {}
+        self._lock = threading.Lock()
+        # Every appliance's commands are recorded here too, tagged with the appliance they went to
+        self.metrics = Metrics()
+        for name, client in self.appliances.items():
+            client.metrics.addHook(lambda event, name=name: self.metrics.record(dict(event, appliance=name)))
+        self.metrics.sources.update(pool=lambda: self.combined("pool"),
+                                    sessions=lambda: self.combined("sessions"),
+                                    retry=lambda: self.combined("retry"))
+
+    # Every appliance is asked at once, with results in the same order as the appliances
+    fanOut = IT.fanOut
+
+    def appliance(self, name):
+        return self.appliances[name]
+
+    def login(self):
+        return self.fanOut(lambda client: client.login(), self.appliances.values())
+
+    def disconnect(self):
+        for client in self.appliances.values():
+            client.disconnect()
+
+    def combined(self, attribute):
+        # The pool, session or retry counters of every appliance added together
+        totals = {}
+        for client in self.appliances.values():
+            for key, value in getattr(client, attribute).stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def owned(self, kind, item_id, name):
+        # Record which appliance an emulation, VI or port lives on, remembering ids seen on several
+        key = (kind, int(item_id))
+        with self._lock:
+            owner = self.owners.get(key)
+            if owner is None:
+                self.owners[key] = name
+            elif owner != name and name not in owner.split(","):
+                self.owners[key] = owner + "," + name
+
+    def owner(self, kind, item_id, appliance=None):
+        # The name of the appliance an emulation, VI or port id belongs to, looking on every appliance the
+        # first time it's asked for. None if it isn't on any of them or it's on several and
+        # appliance isn't given
+        if appliance is not None:
+            return appliance
+        key = (kind, int(item_id))
+        with self._lock:
+            owner = self.owners.get(key)
+        if owner is None:
+            if kind == "emulation":
+                self.getRunningEmulations()
+            elif kind == "port":
+                self.getPorts()
+            else:
+                names = list(self.appliances)
+                found = self.fanOut(lambda name: self.appliances[name].getViByViId(item_id), names)
+                for name, vi in zip(names, found):
+                    if vi is not None and "error" not in vi:
+                        self.owned(kind, item_id, name)
+            with self._lock:
+                owner = self.owners.get(key)
+        if owner is None:
+            return None
+        if "," in owner:
+            print("The " + kind + " id " + str(item_id) + " is on more than one appliance (" + owner + ")")
+            return None
+        return owner
+
+    def unowned(self, kind, item_id):
+        # Why owner gave no appliance for an id, to report back
+        with self._lock:
+            owner = self.owners.get((kind, int(item_id)))
+        if owner is not None and "," in owner:
+            return "on more than one appliance (" + owner + ")"
+        return "not found"
+
+    def route(self, kind, item_id, appliance=None):
+        # The IT client to send an emulation, VI or port id's commands to, see owner
+        name = self.owner(kind, item_id, appliance)
+        return self.appliances[name] if name is not None else None
+
+    def load(self, client):
+        if self.placement == "ports":
+            ports = client.getPortTable()
+            return len(ports) if ports is not None else 0
+        return len(client.getRunningEmulations() or [])
+
+    def place(self):
+        # The name of the least loaded appliance, where anything new goes
+        names = list(self.appliances)
+        loads = self.fanOut(lambda name: self.load(self.appliances[name]), names)
+        return min(zip(names, loads), key=lambda entry: entry[1] if isinstance(entry[1], int) else float("inf"))[0]
+
+    def portTables(self, refresh=False):
+        # Every appliance's PortTable by appliance name, leaving out any that couldn't be listed
+        names = list(self.appliances)
+        tables = self.fanOut(lambda name: self.appliances[name].getPortTable(refresh), names)
+        return {name: ports for name, ports in zip(names, tables) if isinstance(ports, PortTable)}
+
+    def locate(self, address, tables=None):
+        # The names of the appliances with a port named address on them
+        tables = self.portTables() if tables is None else tables
+        return [name for name, ports in tables.items() if ports.getByName(str(address)) is not None]
+
+    def getRunningEmulations(self, refresh=False):
+        names = list(self.appliances)
+        listings = self.fanOut(lambda name: self.appliances[name].getRunningEmulations(refresh), names)
+        emulations = []
+        for name, listing in zip(names, listings):
+            if isinstance(listing, dict):
+                print("Unable to list emulations on " + name + ":", listing["error"])
+                continue
+            for emulation in listing or []:
+                self.owned("emulation", emulation["id"], name)
+                emulations.append(dict(emulation, appliance=name))
+        return emulations
+
+    def getRunningEmulationbyEmulationID(self, emulationId, appliance=None):
+        client = self.route("emulation", emulationId, appliance)
+        return client.getRunningEmulationbyEmulationID(emulationId) if client is not None else None
+
+    def getPorts(self, refresh=False):
+        names = list(self.appliances)
+        listings = self.fanOut(lambda name: self.appliances[name].getPorts(refresh), names)
+        ports = []
+        for name, listing in zip(names, listings):
+            if isinstance(listing, dict):
+                print("Unable to list ports on " + name + ":", listing["error"])
+                continue
+            for port in listing or []:
+                self.owned("port", port["id"], name)
+                ports.append(dict(port, appliance=name))
+        return ports
+
+    def getPort(self, portId, parent=False, appliance=None):
+        name = self.owner("port", portId, appliance)
+        if name is None:
+            return None
+        port = self.appliances[name].getPort(portId, parent)
+        return dict(port, appliance=name) if port is not None else None
+
+    def deletePort(self, portId, appliance=None):
+        client = self.route("port", portId, appliance)
+        return client.deletePort(portId) if client is not None else None
+
+    def deletePortByAddress(self, address, appliance=None):
+        if appliance is None:
+            found = self.locate(ipaddress.ip_address(address) - 1)
+            if len(found) != 1:
+                print("I've not found the port" if not found else
+                      "The port " + str(address) + " is on more than one appliance (" + ",".join(found) + ")")
+                return None
+            appliance = found[0]
+        return self.appliances[appliance].deletePortByAddress(address)
+
+    def createPort(self, wan_number, vlan, address, mask='255.255.255.252', gateway=None, appliance=None):
+        # An address that's already on an appliance is fixed up there, a new one goes to the
+        # least loaded appliance unless appliance says where
+        if appliance is None:
+            found = self.locate(address)
+            if len(found) > 1:
+                print("The port " + str(address) + " is on more than one appliance (" + ",".join(found) + ")")
+                return False
+            appliance = found[0] if found else self.place()
+        print("Creating port " + str(address) + " on " + appliance)
+        return self.appliances[appliance].createPort(wan_number, vlan, address, mask, gateway)
+
+    def reconcilePorts(self, desired, prune=False, dry_run=False, parallelism=None, appliance=None):
+        # Share the desired ports out by the appliance each address is on, or an "appliance" key
+        # in the entry, with new ones going to appliance or else the least loaded appliance, then
+        # reconcile every appliance at once. With prune every appliance is reconciled, so ports
+        # nobody asked for are deleted wherever they are. The plans come back merged, with every
+        # step tagged with its appliance
+        tables = self.portTables(refresh=True)
+        shares = {name: [] for name in tables} if prune else {}
+        invalid = []
+        for entry in desired:
+            if not isinstance(entry, dict):
+                entry = dict(zip(("wan", "vlan", "address", "mask", "gateway"), entry))
+            entry = dict(entry)
+            name = entry.pop("appliance", None)
+            if name is None:
+                found = self.locate(entry["address"], tables)
+                if len(found) > 1:
+                    invalid.append(dict(entry, reason="on more than one appliance (" + ",".join(found) + ")"))
+                    continue
+                if found:
+                    name = found[0]
+                else:
+                    if appliance is None:
+                        appliance = self.place()
+                    name = appliance
+            shares.setdefault(name, []).append(entry)
+        names = list(shares)
+        outcomes = self.fanOut(lambda name: self.appliances[name].reconcilePorts(shares[name], prune, dry_run, parallelism),
+                               names)
+        plan = {"delete_ipv4": [], "delete_vlan": [], "create_vlan": [], "create_ipv4": [],
+                "unchanged": [], "invalid": invalid}
+        result = {"plan": plan, "applied": 0, "failed": []}
+        for name, outcome in zip(names, outcomes):
+            if "error" in outcome:
+                print("Unable to reconcile ports on " + name + ":", outcome["error"])
+                result["failed"].append({"appliance": name, "error": outcome["error"]})
+                continue
+            for phase, steps in outcome["plan"].items():
+                plan[phase] += [dict(step, appliance=name) for step in steps]
+            result["applied"] += outcome["applied"]
+            result["failed"] += [dict(step, appliance=name) for step in outcome["failed"]]
+        return result
+
+    def getAllVis(self, parallelism=None):
+        names = list(self.appliances)
+        listings = self.fanOut(lambda name: self.appliances[name].getAllVis(parallelism), names)
+        vis = []
+        for name, listing in zip(names, listings):
+            if listing is None or isinstance(listing, dict):
+                continue
+            for emulation_vis in listing:
+                if isinstance(emulation_vis, list):
+                    for vi in emulation_vis:
+                        if vi is not None and "id" in vi:
+                            self.owned("vi", vi["id"], name)
+                    emulation_vis = [dict(vi, appliance=name) if vi is not None else None for vi in emulation_vis]
+                vis.append(emulation_vis)
+        return vis
+
+    def getVisByEmulationId(self, emulationId, parallelism=None, appliance=None):
+        name = self.owner("emulation", emulationId, appliance)
+        if name is None:
+            return None
+        return self.tagVis(self.appliances[name].getVisByEmulationId(emulationId, parallelism), name)
+
+    def tagVis(self, vis, name):
+        # Record the appliance as the owner of the VIs and tag them with it
+        if vis is None:
+            return None
+        for vi in vis:
+            if vi is not None and "id" in vi:
+                self.owned("vi", vi["id"], name)
+        return [dict(vi, appliance=name) if vi is not None else None for vi in vis]
+
+    def getViIdsByEmulationId(self, emulationId, appliance=None):
+        name = self.owner("emulation", emulationId, appliance)
+        if name is None:
+            return None
+        vi_ids = self.appliances[name].getViIdsByEmulationId(emulationId)
+        for vi_id in vi_ids or []:
+            self.owned("vi", vi_id, name)
+        return vi_ids
+
+    def getViIdsByEmulationIdAndViName(self, emulationId, names=['Internet', 'MPLS'], impairments=False, appliance=None):
+        name = self.owner("emulation", emulationId, appliance)
+        if name is None:
+            return []
+        return self.tagVis(self.appliances[name].getViIdsByEmulationIdAndViName(emulationId, names, impairments), name)
+
+    def getViByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.getViByViId(vi_id) if client is not None else None
+
+    def getImpairmentsByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.getImpairmentsByViId(vi_id) if client is not None else None
+
+    def getLatencyByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.getLatencyByViId(vi_id) if client is not None else None
+
+    def getLossByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.getLossByViId(vi_id) if client is not None else None
+
+    def getErrorsByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.getErrorsByViId(vi_id) if client is not None else None
+
+    def resetAllImpairmentsByViId(self, vi_id, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.resetAllImpairmentsByViId(vi_id) if client is not None else None
+
+    def applyImpairments(self, vi_id, latency=None, loss=None, errors=None, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.applyImpairments(vi_id, latency, loss, errors) if client is not None else None
+
+    def applyLatency(self, vi_id, latency_value, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.applyLatency(vi_id, latency_value) if client is not None else None
+
+    def applyLoss(self, vi_id, loss_value, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.applyLoss(vi_id, loss_value) if client is not None else None
+
+    def applyErrors(self, vi_id, errors_value, appliance=None):
+        client = self.route("vi", vi_id, appliance)
+        return client.applyErrors(vi_id, errors_value) if client is not None else None
+
+    def applyImpairmentsBulk(self, changes, parallelism=None, appliance=None):
+        # Split the changes by owning appliance and apply each appliance's share at the same time.
+        # appliance says they're all on that one, a VI whose owner isn't known gets {"id", "error"}
+        started = time.monotonic()
+        vi_ids = list(changes)
+        owners = self.fanOut(lambda vi_id: self.owner("vi", vi_id, appliance), vi_ids)
+        shares = {}
+        results = {}
+        for vi_id, name in zip(vi_ids, owners):
+            if name is None or isinstance(name, dict):
+                results[vi_id] = {"id": vi_id, "error": name["error"] if isinstance(name, dict) else
+                                  self.unowned("vi", vi_id)}
+            else:
+                shares.setdefault(name, (self.appliances[name], {}))[1][vi_id] = changes[vi_id]
+        for applied in self.fanOut(lambda share: share[0].applyImpairmentsBulk(share[1], parallelism),
+                                   list(shares.values())):
+            results.update(applied["results"])
+        return {"results": {vi_id: results.get(vi_id) for vi_id in vi_ids},
+                "elapsed": time.monotonic() - started}
+
+    def stopRunningEmulation(self, emulationId, appliance=None):
+        client = self.route("emulation", emulationId, appliance)
+        return client.stopRunningEmulation(emulationId) if client is not None else None
+
+    def teardown(self, emulation_ids=(), addresses=(), parallelism=None, appliance=None):
+        # IT.teardown on every appliance at once, each given the emulations and port addresses it
+        # owns, with the outcomes merged, or all of them on appliance if that's given. An id or
+        # address on more than one appliance is left alone and reported as such
+        started = time.monotonic()
+        outcome = {"emulations": {}, "ports": {}}
+        shares = {}
+        if emulation_ids and appliance is None:
+            self.getRunningEmulations(refresh=True)
+        for emulationId in emulation_ids:
+            name = self.owner("emulation", emulationId, appliance)
+            if name is None:
+                outcome["emulations"][emulationId] = self.unowned("emulation", emulationId)
+            else:
+                shares.setdefault(name, ([], []))[0].append(emulationId)
+        tables = self.portTables(refresh=True) if addresses and appliance is None else {}
+        for address in addresses:
+            found = [appliance] if appliance is not None else self.locate(address, tables)
+            if len(found) == 1:
+                shares.setdefault(found[0], ([], []))[1].append(address)
+            else:
+                outcome["ports"][address] = {"deleted": False, "error": "not found" if not found else
+                                             "on more than one appliance (" + ",".join(found) + ")"}
+        names = list(shares)
+        for name, result in zip(names, self.fanOut(
+                lambda name: self.appliances[name].teardown(shares[name][0], shares[name][1], parallelism), names)):
+            if "error" in result:
+                print("Unable to tear down on " + name + ":", result["error"])
+                outcome["emulations"].update((emulationId, "failed") for emulationId in shares[name][0])
+                outcome["ports"].update((address, {"deleted": False, "error": result["error"]})
+                                        for address in shares[name][1])
+                continue
+            outcome["emulations"].update(result["emulations"])
+            outcome["ports"].update(result["ports"])
+        outcome["elapsed"] = time.monotonic() - started
+        return outcome
+
+    def createEmulation(self, product, devices, overwrite=None, parallelism=None, summarize_routes=False):
+        # An emulation that's already running stays where it is, otherwise pick the quietest INE
+        running = [emulation for emulation in self.getRunningEmulations() if emulation["name"] == product.name]
+        name = running[0]["appliance"] if running else self.place()
+        print("Placing emulation " + product.name + " on " + name)
+        result = self.appliances[name].createEmulation(product, devices, overwrite, parallelism, summarize_routes)
+        emulation = result[0]["emulation"] if isinstance(result, tuple) else result
+        if "id" in emulation:
+            self.owned("emulation", emulation["id"], name)
+        if isinstance(result, tuple):
+            return dict(result[0], appliance=name), result[1]
+        return dict(result, appliance=name)
+
+
+class ImpairmentPlayer:
+    # Plays back impairments over time. profiles maps VI ids to lists of (offset, impairments)
+    # steps, offset being seconds from the start of playback and impairments a dict of latency,
+    # loss and/or errors. Every step is due at a fixed time on the monotonic clock rather than a
+    # sleep after the last one, so a slow INE makes steps late but never pushes the rest back.
+    # If a VI's steps fall due while its previous command is still being sent they're merged into
+    # one command, later values winning, and the steps it replaced are reported as coalesced
+    def __init__(self, client, parallelism=None):
+        self.client = client
+        self.parallelism = parallelism or client.parallelism
+        self.report = []
+        self._heap = []
+        self._pending = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._done = threading.Event()
+        self._outstanding = 0
+        self._executor = None
+        self._thread = None
+        self.started = None
+
+    def ramp(self, field, start, end, duration, interval=1.0):
+        # Steps taking one impairment from start to end in equal increments over duration seconds
+        count = max(1, int(round(duration / interval)))
+        return [(n * duration / count, {field: start + (end - start) * n / count}) for n in range(count + 1)]
+
+    def start(self, profiles):
+        steps = []
+        for vi_id, profile in profiles.items():
+            for number, (offset, impairments) in enumerate(sorted(profile, key=lambda step: step[0])):
+                steps.append((offset, str(vi_id), number, dict(impairments)))
+        heapq.heapify(steps)
+        self._heap = steps
+        self._outstanding = len(steps)
+        if not steps:
+            self._done.set()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.parallelism))
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._schedule, name="impairment-player", daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # Blocks until every step has been applied or coalesced, then returns the timing report
+        if not self._done.wait(timeout):
+            return None
+        self._thread.join()
+        self._executor.shutdown()
+        return self.summary()
+
+    def play(self, profiles):
+        return self.start(profiles).wait()
+
+    def stop(self):
+        # Steps that aren't yet due are dropped, anything already sent is left to finish
+        self._stopped.set()
+        with self._lock:
+            self._outstanding -= len(self._heap)
+            self._heap = []
+            if self._outstanding <= 0:
+                self._done.set()
+
+    def summary(self):
+        with self._lock:
+            steps = sorted(self.report, key=lambda step: (step["due"], step["id"]))
+        errors = [step["error"] for step in steps if step["error"] is not None]
+        return {"steps": steps,
+                "coalesced": sum(1 for step in steps if step["coalesced"]),
+                "failed": sum(1 for step in steps if step["ok"] is False),
+                "mean_error": sum(errors) / len(errors) if errors else 0.0,
+                "max_error": max(errors) if errors else 0.0}
+
+    def _schedule(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if not self._heap:
+                    return
+                offset = self._heap[0][0]
+            # Sleep until the step is due on the playback clock, waking early if stopped
+            if self._stopped.wait(max(0.0, self.started + offset - time.monotonic())):
+                return
+            with self._lock:
+                if not self._heap:
+                    return
+                offset, vi_id, number, impairments = heapq.heappop(self._heap)
+                step = {"id": vi_id, "due": offset, "impairments": impairments, "replaces": []}
+                waiting = self._pending.get(vi_id)
+                if waiting is not None:
+                    # The previous update for this VI hasn't gone out yet, fold it into this one
+                    step["impairments"] = dict(waiting["impairments"], **impairments)
+                    step["replaces"] = waiting["replaces"] + [waiting]
+                if vi_id in self._in_flight:
+                    self._pending[vi_id] = step
+                    continue
+                self._pending.pop(vi_id, None)
+                self._in_flight.add(vi_id)
+            self._executor.submit(self._send, step)
+
+    def _send(self, step):
+        sent = time.monotonic() - self.started
+        try:
+            ok = self.client.applyImpairments(step["id"], **step["impairments"]) is not None
+        except Exception as ex:
+            print("Unable to apply impairments to VI", step["id"], ex)
+            ok = False
+        applied = time.monotonic() - self.started
+        with self._lock:
+            for replaced in step["replaces"]:
+                self.report.append({"id": step["id"], "due": replaced["due"], "impairments": replaced["impairments"],
+                                    "sent": None, "applied": None, "error": None, "coalesced": True, "ok": None})
+            # Timing error is how long after it was due the INE had the step's impairments
+            self.report.append({"id": step["id"], "due": step["due"], "impairments": step["impairments"],
+                                "sent": sent, "applied": applied, "error": applied - step["due"],
+                                "coalesced": False, "ok": ok})
+            self._outstanding -= 1 + len(step["replaces"])
+            following = self._pending.pop(step["id"], None)
+            if following is None:
+                self._in_flight.discard(step["id"])
+            if self._outstanding <= 0:
+                self._done.set()
+        if following is not None:
+            self._executor.submit(self._send, following)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # The IT instance behind the module level helpers. It's created and logged in the first time
+    # it's needed rather than at import, unless set_client has been given one to use instead.
+    # If itrinegyCredentials returns a list of appliances the helpers get an ITCluster over them
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from credentials import itrinegyCredentials
+                iTrinegyCredentials = itrinegyCredentials()
+                clients = []
+                for appliance in (iTrinegyCredentials if isinstance(iTrinegyCredentials, list) else [iTrinegyCredentials]):
+                    # An optional "store" path keeps a SnapshotStore for a fast warm start. One that
+                    # can't be opened, such as a read only store nobody has written yet, just means a cold start
+                    store = None
+                    if appliance.get("store"):
+                        try:
+                            store = SnapshotStore(appliance["store"], appliance.get("store_read_only", False))
+                        except sqlite3.Error as ex:
+                            print("Unable to open the snapshot store " + appliance["store"] + ":", ex)
+                    clients.append(IT(appliance["ip"], appliance["port"],
+                                      appliance["username"], appliance["password"], store=store))
+                    print("Attempting to login to iTrinegy on IP " +
+                          appliance["ip"] + ":" + str(appliance["port"]))
+                client = ITCluster(clients) if isinstance(iTrinegyCredentials, list) else clients[0]
+                client.login()
+                print("We're logged in to iTrinegy INE")
+                # Only once logged in, so the revalidation in the background uses that session
+                # rather than logging in alongside it
+                for appliance in clients:
+                    appliance.warmStart()
+                _client = client
+    return _client
+
+
+def get_metrics(format=None):
+    # A snapshot of the client's command metrics, as a dict or in the Prometheus text format
+    if format == "prometheus":
+        return get_client().metrics.prometheus()
+    return get_client().metrics.snapshot()
+
+
+def set_client(client):
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def warm_up(connections=None, background=True):
+    # Log in and open connections ahead of the first request, by default on a background thread
+    def warm():
+        try:
+            client = get_client()
+            # An ITCluster warms every appliance's pool
+            for appliance in (client.appliances.values() if isinstance(client, ITCluster) else [client]):
+                appliance.pool.warm(connections or appliance.pool.maxsize)
+        except Exception as ex:
+            print("Unable to warm up the iTrinegy client:", ex)
+
+    if not background:
+        warm()
+        return None
+    thread = threading.Thread(target=warm, name="itrinegy-warm-up", daemon=True)
+    thread.start()
+    return thread
 
-iTrinegyCredentials = itrinegyCredentials()
-it = IT(iTrinegyCredentials["ip"], iTrinegyCredentials["port"],
-        iTrinegyCredentials["username"], iTrinegyCredentials["password"])
-print("Attempting to login to iTrinegy on IP " +
-      iTrinegyCredentials["ip"] + ":" + str(iTrinegyCredentials["port"]))
-it.login()
-print("We're logged in to iTrinegy INE")
 
+def __getattr__(name):
+    # Keeps itrinegy.it working for code written against the old import time singleton
+    if name == "it":
+        return get_client()
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
-def create_emulation(product, devices, overwrite=None):
-    return it.createEmulation(product, devices, overwrite)
 
+def routed(appliance):
+    # The keyword argument naming the appliance an id is on, when one is given. Ids are only unique
+    # per appliance, so with an ITCluster the helpers below can be told which appliance is meant
+    return {"appliance": appliance} if appliance is not None else {}
 
-def create_port(wan_number, vlan, address, mask, gateway=None):
-    return it.createPort(wan_number, vlan, address, mask, gateway)
 
+def create_emulation(product, devices, overwrite=None, parallelism=None, summarize_routes=None):
+    return get_client().createEmulation(product, devices, overwrite, parallelism, bool(summarize_routes))
 
-def delete_port_by_port_id(port_id):
-    delete_port = it.deletePort(port_id)
+
+def create_port(wan_number, vlan, address, mask, gateway=None, appliance=None):
+    return get_client().createPort(wan_number, vlan, address, mask, gateway, **routed(appliance))
+
+
+def delete_port_by_port_id(port_id, appliance=None):
+    delete_port = get_client().deletePort(port_id, **routed(appliance))
     if delete_port:
         if delete_port is not None:
             return {"message": 'Port was deleted successfully'}, 200
@@ -710,8 +2648,8 @@ def delete_port_by_port_id(port_id):
         return {"message": 'Port currently in use'}, 403
 
 
-def delete_port_by_port_address(port_address):
-    delete_port = it.deletePortByAddress(port_address)
+def delete_port_by_port_address(port_address, appliance=None):
+    delete_port = get_client().deletePortByAddress(port_address, **routed(appliance))
     if delete_port is not None:
         if delete_port:
             return {"message": 'Port was deleted successfully'}, 200
@@ -719,82 +2657,89 @@ def delete_port_by_port_address(port_address):
         return {"message": 'Port currently in use'}, 403
 
 
-def get_emulation_by_emulation_id(emulation_id):
-    emulation = it.getRunningEmulationbyEmulationID(emulation_id)
+def get_emulation_by_emulation_id(emulation_id, appliance=None):
+    emulation = get_client().getRunningEmulationbyEmulationID(emulation_id, **routed(appliance))
     if emulation is not None:
         return emulation
     else:
         return {"message": 'Emulation not found'}, 404
 
 
-def get_emulations():
-    return it.getRunningEmulations()
+def get_emulations(refresh=None):
+    return get_client().getRunningEmulations(bool(refresh))
 
 
-def get_errors_by_vi_id(vi_id):
-    errors = it.getErrorsByViId(vi_id)
+def get_errors_by_vi_id(vi_id, appliance=None):
+    errors = get_client().getErrorsByViId(vi_id, **routed(appliance))
     if errors is not None:
         return errors
     else:
         return {"message": 'VI not found'}, 404
 
 
-def get_impairments_by_vi_id(vi_id):
-    impairments = it.getImpairmentsByViId(vi_id)
+def get_impairments_by_vi_id(vi_id, appliance=None):
+    impairments = get_client().getImpairmentsByViId(vi_id, **routed(appliance))
     if impairments is not None:
         return impairments
     else:
         return {"message": 'VI not found'}, 404
 
 
-def get_latency_by_vi_id(vi_id):
-    latency = it.getLatencyByViId(vi_id)
+def get_latency_by_vi_id(vi_id, appliance=None):
+    latency = get_client().getLatencyByViId(vi_id, **routed(appliance))
     if latency is not None:
         return latency
     else:
         return {"message": 'VI not found'}, 404
 
 
-def get_loss_by_vi_id(vi_id):
-    loss = it.getLossByViId(vi_id)
+def get_loss_by_vi_id(vi_id, appliance=None):
+    loss = get_client().getLossByViId(vi_id, **routed(appliance))
     if loss is not None:
         return loss
     else:
         return {"message": 'VI not found'}, 404
 
 
-def get_port_by_port_id(port_id, parent=None):
+def get_port_by_port_id(port_id, parent=None, appliance=None):
     if parent:
-        port = it.getPort(port_id, True)
+        port = get_client().getPort(port_id, True, **routed(appliance))
     else:
-        port = it.getPort(port_id)
+        port = get_client().getPort(port_id, **routed(appliance))
     if port is not None:
         return port
     else:
         return {"message": 'Port not found'}, 404
 
 
-def get_ports():
-    return it.getPorts()
+def get_ports(refresh=None):
+    return get_client().getPorts(bool(refresh))
+
 
+def reconcile_ports(desired, prune=None, dry_run=None, parallelism=None, appliance=None):
+    return get_client().reconcilePorts(desired, bool(prune), bool(dry_run), parallelism, **routed(appliance))
 
-def get_router_vis_by_emulation_id(emulation_id, reset=None, firewall=None):
+
+def get_router_vis_by_emulation_id(emulation_id, reset=None, firewall=None, appliance=None):
     vis = []
     if firewall:
-        vis = it.getViIdsByEmulationIdAndViName(
-            emulation_id, ['Internet', 'MPLS', 'Firewall'], True)
+        vis = get_client().getViIdsByEmulationIdAndViName(
+            emulation_id, ['Internet', 'MPLS', 'Firewall'], True, **routed(appliance))
     else:
-        vis = it.getViIdsByEmulationIdAndViName(
-            emulation_id, ['Internet', 'MPLS'], True)
+        vis = get_client().getViIdsByEmulationIdAndViName(
+            emulation_id, ['Internet', 'MPLS'], True, **routed(appliance))
     if reset:
-        for vi in vis:
-            it.resetAllImpairmentsByViId(vi['id'])
+        # An ITCluster tags the VIs with the appliance the emulation is on, which is where they are
+        if appliance is None and vis:
+            appliance = vis[0].get("appliance")
+        get_client().applyImpairmentsBulk(
+            {vi['id']: {"latency": 0, "loss": 0, "errors": 0} for vi in vis}, **routed(appliance))
 
     return vis
 
 
-def get_vi_by_vi_id(vi_id):
-    vi = it.getViByViId(vi_id)
+def get_vi_by_vi_id(vi_id, appliance=None):
+    vi = get_client().getViByViId(vi_id, **routed(appliance))
     if vi is not None:
         return vi
     else:
@@ -802,57 +2747,100 @@ def get_vi_by_vi_id(vi_id):
 
 
 def get_vis():
-    return it.getAllVis()
+    return get_client().getAllVis()
 
 
-def get_vis_by_emulation_id(emulation_id):
-    vis = it.getVisByEmulationId(emulation_id)
+def get_vis_by_emulation_id(emulation_id, appliance=None):
+    vis = get_client().getVisByEmulationId(emulation_id, **routed(appliance))
     if vis is not None:
         return vis
     else:
         return {"message": 'Emulation not found'}, 404
 
 
-def reset_errors_by_vi_id(vi_id):
-    return it.applyErrors(vi_id, 0)
+def reset_errors_by_vi_id(vi_id, appliance=None):
+    return get_client().applyErrors(vi_id, 0, **routed(appliance))
 
 
-def reset_impairments_by_vi_id(vi_id):
-    result = it.resetAllImpairmentsByViId(vi_id)
+def reset_impairments_by_vi_id(vi_id, appliance=None):
+    result = get_client().resetAllImpairmentsByViId(vi_id, **routed(appliance))
     return dict(ChainMap(*result))
 
 
-def reset_latency_by_vi_id(vi_id):
-    return it.applyLatency(vi_id, 0)
+def reset_latency_by_vi_id(vi_id, appliance=None):
+    return get_client().applyLatency(vi_id, 0, **routed(appliance))
 
 
-def reset_loss_by_vi_id(vi_id):
-    return it.applyLoss(vi_id, 0)
+def reset_loss_by_vi_id(vi_id, appliance=None):
+    return get_client().applyLoss(vi_id, 0, **routed(appliance))
 
 
-def set_impairments_by_vi_id(vi_id, latency=None, loss=None, errors=None):
-    result = []
-    if latency is not None:
-        result.append(it.applyLatency(vi_id, latency))
-    if loss is not None:
-        if 0 <= loss <= 100:
-            lossvalue = it.applyLoss(vi_id, loss)
-            result.append(lossvalue)
-        else:
-            return {"message": 'Loss percentage out of range'}, 400
-    if errors is not None:
-        if 0 <= errors <= 100:
-            result.append(it.applyErrors(vi_id, errors))
-        else:
-            return {"message": 'Error percentage out of range'}, 400
-    if result != []:
-        return dict(ChainMap(*result))
-    else:
+def check_impairments(latency=None, loss=None, errors=None):
+    if loss is not None and not 0 <= loss <= 100:
+        return {"message": 'Loss percentage out of range'}, 400
+    if errors is not None and not 0 <= errors <= 100:
+        return {"message": 'Error percentage out of range'}, 400
+    if latency is None and loss is None and errors is None:
         return {"message": 'No impairments provided'}, 400
+    return None
+
+
+def set_impairments_by_vi_id(vi_id, latency=None, loss=None, errors=None, appliance=None):
+    problem = check_impairments(latency, loss, errors)
+    if problem is not None:
+        return problem
+    result = get_client().applyImpairments(vi_id, latency, loss, errors, **routed(appliance))
+    if result is not None:
+        return result
+    else:
+        return {"message": 'Unable to apply impairments'}, 500
+
+
+def set_impairments_bulk(changes, parallelism=None, appliance=None):
+    # changes maps VI ids to {"latency": ..., "loss": ..., "errors": ...}, any of which can be left out
+    problems = {}
+    valid = {}
+    for vi_id, impairments in changes.items():
+        unknown = set(impairments) - {"latency", "loss", "errors"}
+        if unknown:
+            problems[vi_id] = {"message": 'Unknown impairments ' + ', '.join(sorted(unknown))}
+            continue
+        problem = check_impairments(**impairments)
+        if problem is not None:
+            problems[vi_id] = problem[0]
+        else:
+            valid[vi_id] = impairments
+    result = get_client().applyImpairmentsBulk(valid, parallelism, **routed(appliance))
+    result["results"].update(problems)
+    return result
+
+
+def play_impairments(profiles, parallelism=None):
+    # profiles maps VI ids to [(offset, {"latency": ..., "loss": ..., "errors": ...}), ...]
+    for vi_id, profile in profiles.items():
+        for offset, impairments in profile:
+            unknown = set(impairments) - {"latency", "loss", "errors"}
+            if unknown:
+                return {"message": 'Unknown impairments ' + ', '.join(sorted(unknown)), "id": vi_id}, 400
+            problem = check_impairments(**impairments)
+            if problem is not None:
+                return dict(problem[0], id=vi_id), problem[1]
+    return ImpairmentPlayer(get_client(), parallelism).play(profiles)
+
+
+def watch_changes(callback, interval=5.0):
+    # Calls callback with every change to the emulations, ports and VIs, polling every interval seconds
+    watcher = ITWatcher(get_client(), interval)
+    watcher.subscribe(callback)
+    return watcher.start()
+
+
+def teardown(emulation_ids=None, addresses=None, parallelism=None, appliance=None):
+    return get_client().teardown(emulation_ids or [], addresses or [], parallelism, **routed(appliance))
 
 
-def stop_emulation_by_emulation_id(emulation_id):
-    result = it.stopRunningEmulation(emulation_id)
+def stop_emulation_by_emulation_id(emulation_id, appliance=None):
+    result = get_client().stopRunningEmulation(emulation_id, **routed(appliance))
     if result is not None:
         return result
     else:
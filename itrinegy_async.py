@@ -0,0 +1,503 @@
+import asyncio
+import ipaddress
+import time
+from collections import deque
+
+from itrinegy import BaseIT, PortTable, RetryPolicy, quote_state
+
+
+class AsyncConnection:
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.created = self.last_used = time.monotonic()
+
+    def isAlive(self):
+        # A healthy idle connection has been closed neither by us nor by the INE
+        return not (self.writer.is_closing() or self.reader.at_eof())
+
+    async def read(self):
+        # Same framing as ResponseReader: the reply is complete once it ends in a newline that
+        # isn't inside a quoted value. Returns the decoded reply and whether the INE closed the connection
+        chunks = []
+        state = (False, False)
+        while True:
+            # A reply that never completes times out rather than holding the connection forever
+            chunk = await asyncio.wait_for(self.reader.read(65536), self.timeout)
+            if not chunk:
+                return b''.join(chunks).decode('utf-8'), True
+            chunks.append(chunk)
+            state = quote_state(chunk, 0, len(chunk), state)
+            if chunk[-1] == 10 and not state[0]:
+                return b''.join(chunks).decode('utf-8'), False
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    def __init__(self, factory, maxsize=4, idle_timeout=60.0, timeout=None):
+        self.factory = factory
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "evictions": 0}
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxsize)
+
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if time.monotonic() - conn.last_used > self.idle_timeout or not conn.isAlive():
+                    conn.close()
+                    self.stats["evictions"] += 1
+                    continue
+                self.stats["hits"] += 1
+                return conn
+            self.stats["misses"] += 1
+            reader, writer = await self.factory()
+            return AsyncConnection(reader, writer, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        conn.last_used = time.monotonic()
+        self._idle.append(conn)
+        self._slots.release()
+
+    def discard(self, conn):
+        conn.close()
+        self._slots.release()
+
+    def reconnected(self):
+        self.stats["reconnects"] += 1
+
+    def close(self):
+        idle, self._idle = self._idle, deque()
+        for conn in idle:
+            conn.close()
+
+
+class AsyncIT(BaseIT):
+    # asyncio version of IT. Every method is a coroutine with the same name and arguments as on IT,
+    # and independent round-trips (the VIs of an emulation, the VIs created for a new emulation) are
+    # sent concurrently, limited to max_in_flight commands at a time
+    def __init__(self, ipstr, port, username, password, pool_size=4, max_in_flight=16, idle_timeout=60.0,
+                 timeout=30.0):
+        super().__init__(ipstr, port, username, password)
+        self.timeout = timeout
+        self.pool = AsyncConnectionPool(self.connect, pool_size, idle_timeout, timeout)
+        self.max_reconnects = 3
+        self.retry = RetryPolicy()
+        self.session_id = ""
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._login_lock = asyncio.Lock()
+
+    async def connect(self):
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.ipstr, self.port), self.timeout)
+        except OSError as ex:
+            print("Socket or connection error while initiating contact with INE")
+            raise ConnectionError(ex)
+
+    async def disconnect(self):
+        self.pool.close()
+
+    async def sendCommand(self, command, noSession=False):
+        async with self._in_flight:
+            return await self._send(command, noSession)
+
+    async def _send(self, command, noSession):
+        reconnects = 0
+        while True:
+            session_id = self.session_id
+            if not noSession:
+                # Append the session ID to the command
+                payload = self.encodeCommand(command, session_id)
+            else:
+                # Leave the session ID off
+                payload = self.encodeCommand(command)
+            conn = await self.pool.acquire()
+            try:
+                conn.writer.writelines(payload)
+                await conn.writer.drain()
+                data, closed = await conn.read()
+                if not data and closed:
+                    # The INE dropped an idle connection before we got a reply
+                    raise BrokenPipeError
+            except (BrokenPipeError, ConnectionResetError):
+                # Reconnect and try again
+                self.pool.discard(conn)
+                self.pool.reconnected()
+                reconnects += 1
+                if reconnects > self.max_reconnects:
+                    raise
+                continue
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+            if closed:
+                self.pool.discard(conn)
+            else:
+                self.pool.release(conn)
+            result = data.rstrip()
+            if "Unable to find user session" not in result:
+                return result
+            # Only the first command to notice the expiry logs in again, the rest wait for it
+            async with self._login_lock:
+                if self.session_id == session_id:
+                    print("User session expired, fetching another one...")
+                    await self._login()
+
+    async def login(self):
+        async with self._login_lock:
+            await self._login()
+
+    async def _login(self):
+        # Build login command
+        command = '--login "' + self.username + ';' + self.password + '"'
+        # Send command with noSession as True as we do not yet have a user session
+        self.session_id = await self._send(command, True)
+        print("Login successful. SessionID is " +
+              self.session_id.replace("--sessionId ", "").replace('"', ""))
+
+    async def getRunningEmulations(self):
+        result = await self.sendCommand('--getemulations')
+        return self.parseEmulations(result)
+
+    async def getRunningEmulationbyEmulationID(self, emulationId):
+        runningemulations = await self.getRunningEmulations()
+        return next((d for d in runningemulations if d['id'] == int(emulationId)), None)
+
+    async def getPorts(self):
+        result = await self.sendCommand('--getAllPorts')
+        if result is not None:
+            return self.parsePorts(result)
+
+    async def getPort(self, portId, parent=False):
+        ports = await self.getPorts()
+        port = next((d for d in ports if d['id'] == int(portId)), None)
+        if parent and port is not None:
+            port["parent"] = next(
+                (d for d in ports if port["parent"] is not None and d['id'] == int(port["parent"])), None)
+        return port
+
+    async def deletePort(self, portId):
+        command = '--delPortModule ' + str(portId)
+        result = await self.retry.runAsync(lambda: self.sendCommand(command))
+        if result == "--ok":
+            return True
+        print(result)
+        return False
+
+    async def deletePortByAddress(self, address):
+        ports = await self.getPorts()
+        address = str(ipaddress.ip_address(address)-1)
+        port = next((d for d in ports if d['name'] == address), None)
+        if port is None:
+            print("I've not found the port")
+            return None
+        parent = next((d for d in ports if port["parent"] is not None and d['id'] == int(port["parent"])), None)
+        if parent is None:
+            return False
+        print("Deleting port", port["id"], "and the parent", parent["id"])
+        await self.deletePort(port["id"])
+        await self.deletePort(parent["id"])
+        return True
+
+    async def createPort(self, wan_number, vlan, address, mask='255.255.255.252', gateway=None):
+        interface = self.wanInterface(wan_number)
+        if interface is None:
+            return False
+        ports = await self.getPorts()
+        # Check if the port exists first
+        port = next((d for d in ports if d['name'] == address), None)
+        parent = None
+        if port is not None:
+            parent = next((d for d in ports if port["parent"] is not None and d['id'] == int(port["parent"])), None)
+        if port is not None and parent is not None:
+            if parent["name"] != str(interface) + "." + str(vlan):
+                print("Existing port VLAN is not the same, deleting...")
+                await self.deletePort(port["id"])
+                await self.deletePort(parent["id"])
+            else:
+                print("Port already appears to be correct")
+                return False
+        else:
+            print("Port does not exist, creating it")
+
+        vlan_command, ipv4_command = self.portCommands(
+            interface, vlan, address, mask, gateway)
+        print(await self.sendCommand(vlan_command))
+        print(await self.sendCommand(ipv4_command))
+        return True
+
+    async def reconcilePorts(self, desired, prune=False, dry_run=False):
+        # The asyncio version of IT.reconcilePorts, each phase's steps are gathered together
+        plan = self.planPorts(PortTable(await self.getPorts()), desired, prune)
+        for line in self.describePlan(plan):
+            print(line)
+        if dry_run:
+            return {"plan": plan, "applied": 0, "failed": []}
+
+        async def delete(step):
+            return await self.deletePort(step["id"])
+
+        async def createVlan(step):
+            command = self.portCommands(step["interface"], step["vlan"], "", "", None)[0]
+            return await self.sendCommand(command) == "--ok"
+
+        async def createIpv4(step):
+            if (step["interface"], step["vlan"]) in failed_vlans:
+                return False
+            command = self.portCommands(step["interface"], step["vlan"], step["name"], step["mask"], step["gateway"])[1]
+            return await self.sendCommand(command) == "--ok"
+
+        failed = []
+        failed_vlans = set()
+        applied = 0
+        for phase, func in (("delete_ipv4", delete), ("delete_vlan", delete),
+                            ("create_vlan", createVlan), ("create_ipv4", createIpv4)):
+            results = await asyncio.gather(*(func(step) for step in plan[phase]), return_exceptions=True)
+            for step, ok in zip(plan[phase], results):
+                if ok is True:
+                    applied += 1
+                    continue
+                failed.append(dict(step, phase=phase))
+                if phase == "create_vlan":
+                    failed_vlans.add((step["interface"], step["vlan"]))
+        return {"plan": plan, "applied": applied, "failed": failed}
+
+    async def getAllVis(self):
+        emulations = await self.getRunningEmulations()
+        if emulations is None:
+            return None
+        return list(await asyncio.gather(
+            *(self.getVisByEmulationId(emulation["id"]) for emulation in emulations)))
+
+    async def getVisByEmulationId(self, emulationId):
+        vi_Ids = await self.getViIdsByEmulationId(emulationId)
+        if vi_Ids is None:
+            return None
+        return list(await asyncio.gather(*(self.getViByViId(vi) for vi in vi_Ids)))
+
+    async def getViIdsByEmulationId(self, emulationId):
+        command = '--emulationId ' + str(emulationId) + ' --getVIsForEmulation'
+        result = await self.sendCommand(command)
+        if result is not None and not result.startswith("--error"):
+            return self.parseViIds(result)
+        return None
+
+    async def getViIdsByEmulationIdAndViName(self, emulationId, names=['Internet', 'MPLS'], impairments=False):
+        vis = await self.getVisByEmulationId(emulationId)
+        if vis is None:
+            return []
+        namedVis = [d for d in vis if d is not None and d['name'] in names]
+        if impairments:
+            for vi in namedVis:
+                vi["impairments"] = self.impairmentsFromVi(vi)
+        return namedVis
+
+    async def getViByViId(self, vi_id):
+        result = await self.sendCommand('--Id ' + str(vi_id) + ' --getVISettings')
+        return self.parseViSettings(result)
+
+    async def getImpairmentsByViId(self, vi_id):
+        vi = await self.getViByViId(vi_id)
+        if vi is not None:
+            return self.impairmentsFromVi(vi)
+
+    async def getLatencyByViId(self, vi_id):
+        vi = await self.getViByViId(vi_id)
+        if vi is not None:
+            return self.latencyFromVi(vi)
+
+    async def getLossByViId(self, vi_id):
+        vi = await self.getViByViId(vi_id)
+        if vi is not None:
+            return self.lossFromVi(vi)
+
+    async def getErrorsByViId(self, vi_id):
+        vi = await self.getViByViId(vi_id)
+        if vi is not None:
+            return self.errorsFromVi(vi)
+
+    async def resetAllImpairmentsByViId(self, vi_id):
+        applied = await self.applyImpairments(vi_id, 0, 0, 0)
+        if applied is None:
+            return [None, None, None]
+        return [{'latency': applied['latency']}, {'loss': applied['loss']}, {'errors': applied['errors']}]
+
+    async def applyImpairments(self, vi_id, latency=None, loss=None, errors=None):
+        # Any mix of latency, loss and errors in one command, as IT.applyImpairments
+        command, applied = self.impairmentsCommand(vi_id, latency, loss, errors)
+        if not applied:
+            return {}
+        result = await self.sendCommand(command)
+        if result == "--ok":
+            return applied
+
+    async def applyImpairmentsBulk(self, changes):
+        # One combined command per VI, all of them gathered together, see IT.applyImpairmentsBulk
+        started = time.monotonic()
+        vi_ids = list(changes)
+        results = await asyncio.gather(
+            *(self.applyImpairments(vi_id, **changes[vi_id]) for vi_id in vi_ids), return_exceptions=True)
+        results = [{"id": vi_id, "error": str(result)} if isinstance(result, Exception) else result
+                   for vi_id, result in zip(vi_ids, results)]
+        return {"results": dict(zip(vi_ids, results)),
+                "elapsed": time.monotonic() - started}
+
+    async def applyLatency(self, vi_id, latency_value):
+        latency_value = latency_value/2
+        result = await self.sendCommand(self.latencyCommand(vi_id, latency_value))
+        if result == "--ok":
+            return {'latency': latency_value*2}
+
+    async def applyLoss(self, vi_id, loss_percent):
+        loss_percent = loss_percent/2
+        result = await self.sendCommand(self.lossCommand(vi_id, loss_percent))
+        if result == "--ok":
+            return {'loss': loss_percent*2}
+
+    async def applyErrors(self, vi_id, error_percent):
+        error_percent = error_percent/2
+        result = await self.sendCommand(self.errorsCommand(vi_id, error_percent))
+        if result == "--ok":
+            return {'errors': error_percent*2}
+
+    async def stopRunningEmulation(self, emulationId):
+        emulation = await self.getRunningEmulationbyEmulationID(emulationId)
+        if emulation is None:
+            return None
+        print("Stopping emulation...")
+        result = await self.sendCommand('--emulationId ' + str(emulationId) + ' --stop')
+        if result == "--ok":
+            return "Emulation stopped"
+
+    async def teardown(self, emulation_ids=(), addresses=()):
+        # The asyncio version of IT.teardown, each stage is gathered together
+        started = time.monotonic()
+        outcome = {"emulations": {}, "ports": {}}
+        running = {emulation["id"] for emulation in await self.getRunningEmulations()} if emulation_ids else set()
+        ports = PortTable(await self.getPorts()) if addresses else PortTable([])
+
+        stopping = [int(emulationId) for emulationId in emulation_ids if int(emulationId) in running]
+        for emulationId in emulation_ids:
+            if int(emulationId) not in running:
+                outcome["emulations"][emulationId] = "not found"
+        results = await asyncio.gather(
+            *(self.sendCommand('--emulationId ' + str(emulationId) + ' --stop') for emulationId in stopping),
+            return_exceptions=True)
+        for emulationId, result in zip(stopping, results):
+            outcome["emulations"][emulationId] = "stopped" if result == "--ok" else "failed"
+
+        deleting = []
+        for address in addresses:
+            port = ports.getByName(address)
+            if port is None:
+                outcome["ports"][address] = {"deleted": False, "error": "not found"}
+            else:
+                deleting.append((address, port))
+        results = await asyncio.gather(*(self.deletePort(port["id"]) for address, port in deleting),
+                                       return_exceptions=True)
+        for (address, port), ok in zip(deleting, results):
+            outcome["ports"][address] = {"deleted": ok is True}
+        gone = {port["id"] for address, port in deleting if outcome["ports"][address]["deleted"]}
+
+        vlans = {}
+        for address, port in deleting:
+            parent = ports.getParent(port["id"])
+            if parent is not None and parent["parent"] is not None:
+                outcome["ports"][address]["vlan"] = parent["name"]
+                vlans.setdefault(parent["id"], (parent, []))[1].append(address)
+        emptied = [(parent, owners) for parent, owners in vlans.values()
+                   if all(child["id"] in gone for child in ports.getChildren(parent["id"]))]
+        results = await asyncio.gather(*(self.deletePort(parent["id"]) for parent, owners in emptied),
+                                       return_exceptions=True)
+        for (parent, owners), ok in zip(emptied, results):
+            for address in owners:
+                outcome["ports"][address]["vlan_deleted"] = ok is True
+        for parent, owners in vlans.values():
+            for address in owners:
+                outcome["ports"][address].setdefault("vlan_deleted", None)
+        outcome["elapsed"] = time.monotonic() - started
+        return outcome
+
+    async def createEmulation(self, product, devices, overwrite=None, summarize_routes=False):
+        emulations = await self.getRunningEmulations()
+        for emulation in emulations:
+            if emulation["name"] == product.name:
+                if overwrite:
+                    await self.stopRunningEmulation(emulation["id"])
+                else:
+                    return {"message": "Emulation already running",
+                            "emulation": emulation}, 400
+
+        emulationId = await self.sendCommand('--addEmulation "' + product.name + '"')
+
+        FW_Vi, Outer_Vi, Internet_Vi, MPLS_Vi, device_vis = self.planEmulation(
+            product, devices)
+        report = {}
+        if summarize_routes:
+            report["routes_removed"] = 0
+            for vi in (Outer_Vi, Internet_Vi, MPLS_Vi):
+                vi["routes"], removed = self.summarizeRoutes(vi["routes"])
+                report["routes_removed"] += removed
+
+        # Every VI is independent of the others until it's amended, so create them all at once
+        links = await asyncio.gather(
+            self.createLinkVi(emulationId, MPLS_Vi, Outer_Vi),
+            self.createLinkVi(emulationId, Internet_Vi, Outer_Vi),
+            self.createLinkVi(emulationId, Outer_Vi, FW_Vi))
+        vis = [vi for link in links for vi in link]
+        vis.extend(await asyncio.gather(
+            *(self.createObjectVi(emulationId, vi) for vi in device_vis + [MPLS_Vi, Internet_Vi, Outer_Vi, FW_Vi])))
+
+        # A VI the INE wouldn't create has no id to amend
+        failed = [vi["name"] for vi in vis if vi["id"].startswith("--error")]
+        if not failed:
+            amended = await asyncio.gather(*(self.amendVi(emulationId, vi) for vi in vis))
+            failed = [vi["name"] for vi, ok in zip(vis, amended) if ok is not True]
+        if failed:
+            # Don't start an emulation that's only half built
+            return {"message": "Emulation not started, unable to build every VI",
+                    "emulation": {"id": int(emulationId.replace("--emulationId ", "")), "name": product.name},
+                    "failed": failed, **report}, 500
+
+        # Finally, start the emulation
+        result = await self.sendCommand(emulationId + ' --start')
+        print("Result:", result)
+        return {"id": int(emulationId.replace("--emulationId ", "")),
+                "name": product.name, **report}
+
+    async def createObjectVi(self, emulationId, vi):
+        vi["id"] = await self.createVi(emulationId, vi["name"])
+        return self.planObjectVi(vi)
+
+    async def amendVi(self, emulationId, vi):
+        command = self.amendCommand(vi)
+        result = await self.retry.runAsync(lambda: self.sendCommand(command))
+        if vi.get("address"):
+            if result == self.noSuchPortError(vi):
+                print("Looks like the port doesn't exist...")
+                await self.createPort(vi["number"], vi["vlan"],
+                                      vi["address"], vi["mask"], vi["gateway"])
+                result = await self.retry.runAsync(lambda: self.sendCommand(command))
+        print(result)
+        return result == "--ok"
+
+    async def createLinkVi(self, emulationId, from_vi, to_vi):
+        vis = self.planLinks(from_vi, to_vi)
+        ids = await asyncio.gather(*(self.createVi(emulationId, vi["name"]) for vi in vis))
+        for vi, vi_id in zip(vis, ids):
+            vi["id"] = vi_id
+        return vis
+
+    async def createVi(self, emulationId, name):
+        result = await self.sendCommand(emulationId + ' ' + '--addVi "' + str(name) + '"')
+        return result.replace("--id ", "")